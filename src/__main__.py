@@ -2,8 +2,8 @@
 # Copyright (c) 2021-2023 Walbrix Corporation
 # https://github.com/wbrxcorp/genpack/blob/main/LICENSE
 
-import os,sys,subprocess,atexit,logging
-import upstream,workdir,genpack_profile,genpack_artifact,qemu,global_options
+import os,sys,shutil,subprocess,atexit,logging
+import upstream,workdir,genpack_profile,genpack_artifact,qemu,global_options,scheduler,timing,tracing,privhelper
 from sudo import sudo
 
 def prepare(args):
@@ -15,6 +15,7 @@ def prepare(args):
             profiles.append(genpack_profile.Profile(profile))
     if len(profiles) == 0: profiles.append(genpack_profile.Profile("default"))
 
+    genpack_profile.extract_stage3_for_profiles(profiles)
     disable_using_binpkg = args.disable_using_binpkg
     for profile in profiles:
         print("Preparing profile %s..." % profile.name)
@@ -32,6 +33,53 @@ def bash(args):
     profile = genpack_profile.Profile(args.profile)
     genpack_profile.bash(profile, args.bind)
 
+def build_artifact_if_necessary(artifact, persistent_container = False):
+    if artifact.is_up_to_date():
+        print("Artifact %s is up-to-date" % artifact.name)
+    else:
+        print("Building artifact %s..." % artifact.name)
+        with timing.Recorder() as recorder:
+            genpack_artifact.build(artifact, persistent_container)
+        genpack_artifact.save_timings(artifact, recorder, "build")
+
+def pack_artifact_if_necessary(artifact, compression_override = None, incremental = False):
+    if not artifact.is_outfile_up_to_date():
+        print("Packing artifact %s..." % artifact.name)
+        with timing.Recorder() as recorder:
+            genpack_artifact.pack(artifact, None, compression_override, incremental)
+        genpack_artifact.save_timings(artifact, recorder, "pack")
+
+def report_failed_jobs(failed_jobs, keep_going = False):
+    if len(failed_jobs) == 0: return
+    #else
+    message = "Failed jobs: %s" % ", ".join([job.name for job in failed_jobs])
+    if keep_going: logging.error(message)
+    else: raise Exception(message)
+
+def build_parallel(args, artifacts, profiles):
+    # profile prepare -> artifact build -> pack
+    # builds on the same profile are serialized as they share the profile's /var/cache
+    jobs = []
+    prepare_jobs = {}
+    disable_using_binpkg = args.disable_using_binpkg
+    for profile in profiles:
+        job = scheduler.Job("prepare %s" % profile.name, 
+            lambda profile=profile: genpack_profile.prepare(profile, disable_using_binpkg), 
+            resource="profile:%s" % profile.name)
+        prepare_jobs[profile] = job
+        jobs.append(job)
+    for artifact in artifacts:
+        profile = artifact.get_profile()
+        build_job = scheduler.Job("build %s" % artifact.name, 
+            lambda artifact=artifact: build_artifact_if_necessary(artifact, args.persistent_container), 
+            [prepare_jobs[profile]], "profile:%s" % profile.name)
+        pack_job = scheduler.Job("pack %s" % artifact.name, 
+            lambda artifact=artifact: pack_artifact_if_necessary(artifact, args.compression_override, args.incremental), 
+            [build_job])
+        jobs += [build_job, pack_job]
+
+    report_failed_jobs(scheduler.run(jobs, args.jobs, args.keep_going), args.keep_going)
+
 def build(args):
     artifacts = []
     if len(args.artifact) == 0 and os.path.isdir("./artifacts"):
@@ -48,14 +96,21 @@ def build(args):
         else:
             artifacts[0].set_active_variant(args.variant)
 
-    profiles = set()
+    profiles = []
     profiles_prepared = set()
 
     for artifact in artifacts:
         if not artifact.arch_matches():
             raise Exception("Architecture mismatch: %s" % artifact.name)
-        profiles.add(artifact.get_profile())
+        if artifact.get_profile() not in profiles: profiles.append(artifact.get_profile())
+
+    genpack_profile.extract_stage3_for_profiles(profiles)
+    if args.jobs > 1:
+        build_parallel(args, artifacts, profiles)
+        print("Done.")
+        return
 
+    #else
     disable_using_binpkg = args.disable_using_binpkg
     for profile in profiles:
         print("Preparing profile %s..." % profile.name)
@@ -68,25 +123,30 @@ def build(args):
             else:
                 raise e
 
+    # when pipelined, packing of an artifact runs in background while the next one is being built
+    pack_queue = scheduler.BackgroundQueue(args.pipeline_depth) if args.pipeline_depth > 0 else None
+
     for artifact in artifacts:
         if artifact.get_profile() not in profiles_prepared:
             logging.warning("Profile %s is not prepared. Skipping %s." % (artifact.get_profile().name, artifact.name))
             continue
         try:
-            if artifact.is_up_to_date():
-                print("Artifact %s is up-to-date" % artifact.name)
+            build_artifact_if_necessary(artifact, args.persistent_container)
+            if pack_queue is not None:
+                pack_queue.submit(scheduler.Job("pack %s" % artifact.name, 
+                    lambda artifact=artifact: pack_artifact_if_necessary(artifact, args.compression_override, args.incremental)))
+                if len(pack_queue.failed) > 0 and not args.keep_going: break
             else:
-                print("Building artifact %s..." % artifact.name)
-                genpack_artifact.build(artifact)
-            if not artifact.is_outfile_up_to_date():
-                print("Packing artifact %s..." % artifact.name)
-                genpack_artifact.pack(artifact, None, args.compression_override)
+                pack_artifact_if_necessary(artifact, args.compression_override, args.incremental)
         except Exception as e:
             if args.keep_going:
                 logging.error("Error occurred while building artifact %s: %s" % (artifact.name, str(e)))
             else:
+                if pack_queue is not None: pack_queue.join()
                 raise e
 
+    if pack_queue is not None: report_failed_jobs(pack_queue.join(), args.keep_going)
+
     print("Done.")
     
 def run(args):
@@ -96,13 +156,27 @@ def run(args):
     if not artifact.is_up_to_date():
         print("Artifact %s is not up-to-date" % artifact.name)
         sys.exit(1)
+    if args.record_boot_order and shutil.which("strace") is None:
+        raise Exception("strace is required to record boot order")
 
     print("Pressing ']' 3 times will exit the container and return to the host.")
     cmdline = ["systemd-nspawn", "--suppress-sync=true", "-M", "genpack-run-%d" % os.getpid(), 
             "-q", "-D", artifact.get_workdir(), "--network-veth"] + global_options.env_as_systemd_nspawn_args()
     if args.bash: cmdline.append("/bin/bash")
     else: cmdline.append("-b")
-    subprocess.call(sudo(cmdline))
+    if not args.record_boot_order:
+        subprocess.call(sudo(cmdline))
+        return
+    #else
+    # trace every process in the container to learn which files are needed during boot(in order)
+    strace_log = os.path.join(workdir.get_arch("index"), "strace-%d.log" % os.getpid())
+    subprocess.call(sudo(["strace", "-f", "-qq", "-s", "4096", "-o", strace_log, 
+        "-e", "trace=" + ','.join(genpack_artifact.STRACE_SYSCALLS)] + cmdline))
+    if not os.path.isfile(strace_log): raise Exception("strace failed to run")
+    #else
+    privhelper.chown(strace_log, os.getuid(), os.getgid())
+    genpack_artifact.save_boot_order(artifact, genpack_artifact.parse_strace_log(strace_log, artifact.get_workdir()))
+    os.unlink(strace_log)
 
 def _qemu(args):
     artifact = genpack_artifact.Artifact(args.artifact)
@@ -110,17 +184,51 @@ def _qemu(args):
     outfile = artifact.get_outfile()
     qemu.run(outfile, os.path.join(args.workdir, "qemu.img"), args.drm, args.data_volume, args.system_ini)
 
+def bench_pack(args):
+    artifact = genpack_artifact.Artifact(args.artifact)
+    if args.variant is not None: artifact.set_active_variant(args.variant)
+    if not os.path.isdir(artifact.get_workdir()):
+        raise Exception("Artifact %s has not been built yet" % artifact.name)
+    #else
+    compressions = args.compression if len(args.compression) > 0 else list(genpack_artifact.COMPRESSION_PRESETS.keys())
+    results = genpack_artifact.bench_pack(artifact, compressions)
+    print("%-16s %10s %14s %14s" % ("compression", "pack(sec)", "size(bytes)", "read(MiB/s)"))
+    for compression, pack_time, image_size, read_bytes, read_time in results:
+        print("%-16s %10.1f %14d %14.1f" % (compression, pack_time, image_size, read_bytes / 1024 / 1024 / max(read_time, 0.001)))
+
+def stats(args):
+    for category in timing.HISTORY_CATEGORIES:
+        names = args.name if len(args.name) > 0 else timing.get_history_names(category)
+        for name in names:
+            runs = timing.load_history(category, name)
+            for kind in sorted(set(run["kind"] for run in runs)):
+                runs_of_kind = [run for run in runs if run["kind"] == kind]
+                print("%s %s(%s): %d runs" % (category[:-1], name, kind, len(runs_of_kind)))
+                for phase_name, seconds, baseline, regression in timing.compare(runs_of_kind, args.baseline_runs):
+                    if baseline is None:
+                        print("  %-40s %8.1f sec" % (phase_name, seconds))
+                    else:
+                        change = (seconds - baseline) / baseline * 100 if baseline > 0 else 0
+                        print("  %-40s %8.1f sec(baseline %.1f sec, %+.0f%%)%s" % (phase_name, seconds, baseline, change, " REGRESSION" if regression else ""))
+
 def clean(args):
-    subprocess.check_call(sudo(["rm", "-rf", workdir.get(None, False)]))
+    workdir.unmount_all(workdir.get(None, False))
+    privhelper.rm([workdir.get(None, False)])
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
     parser.add_argument("--base", default=None, help="Base URL contains dirs 'releases' 'snapshots'")
+    parser.add_argument("--download-connections", default=1, type=int, help="Number of connections to download a large file with")
+    parser.add_argument("--offline", action="store_true", help="Don't access network. Use cached tarballs and metadata only")
     parser.add_argument("--workdir", default=None, help="Working directory to use(default:./work)")
     parser.add_argument("--env", default=None, help="Environment variable in NAME=VALUE format (comma separated)")
     parser.add_argument('--cpus', default=None, type=int, help='Number of CPUs to use')
+    parser.add_argument('--shared-stage3', default=None, choices=["overlay", "reflink"], help='Extract stage3 once and share it among profiles using overlayfs or reflink copy')
+    parser.add_argument('--privileged-helper', action='store_true', help='Run privileged operations through a helper started via sudo only once')
+    parser.add_argument('--trace', default=None, help='Write timeline of subprocesses, jobs, phases and lock waits to this file in Chrome trace event format')
+    parser.add_argument('--content-digest', action='store_true', help='Decide whether artifacts need rebuild by content digest instead of mtime')
 
     subparsers = parser.add_subparsers()
     # prepare subcommand
@@ -142,7 +250,11 @@ if __name__ == "__main__":
     build_parser.add_argument('--keep-going', action='store_true', help='Keep going even if an error occurs')
     build_parser.add_argument('--disable-using-binpkg', action='store_true', help='Disable using binary packages')
     build_parser.add_argument('--variant', default=None, help='Variant to build')
-    build_parser.add_argument('--compression-override', default=None, help='Override compression method')
+    build_parser.add_argument('--compression-override', default=None, help='Override compression method(preset name, method or method:level)')
+    build_parser.add_argument('--persistent-container', action='store_true', help='Run all build steps of an artifact in single long-lived container')
+    build_parser.add_argument('--incremental', action='store_true', help='Pack only changes since the last full pack into a delta image(<outfile>.delta.squashfs). The outfile alone stays out of date; the delta must be stacked on it by an external loader(qemu doesn\'t)')
+    build_parser.add_argument('--pipeline-depth', default=0, type=int, help='Pack up to N artifacts in background while building next ones(0 to disable)')
+    build_parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of jobs(profile prepare, artifact build, pack) to run in parallel')
     build_parser.set_defaults(func=build)
 
     # run subcommand
@@ -150,6 +262,7 @@ if __name__ == "__main__":
     run_parser.add_argument('--bash', action='store_true', help='Run bash instead of spawning container')
     run_parser.add_argument('artifact', nargs='?', default='default', help='Artifact to run')
     run_parser.add_argument('--variant', default=None, help='Variant to run')
+    run_parser.add_argument('--record-boot-order', action='store_true', help='Record order of files accessed while running, to be used for file placement on next pack')
     run_parser.set_defaults(func=run)
 
     # qemu subcommand
@@ -161,6 +274,19 @@ if __name__ == "__main__":
     qemu_parser.add_argument('--system-ini', help='system.ini file when running qemu')
     qemu_parser.set_defaults(func=_qemu)
 
+    # bench-pack subcommand
+    bench_pack_parser = subparsers.add_parser('bench-pack', help='Compare compression settings on a built artifact')
+    bench_pack_parser.add_argument('artifact', nargs='?', default='default', help='Artifact to pack')
+    bench_pack_parser.add_argument('--variant', default=None, help='Variant to pack')
+    bench_pack_parser.add_argument('--compression', action='append', default=[], help='Compression(preset name, method or method:level) to try(default:all presets)')
+    bench_pack_parser.set_defaults(func=bench_pack)
+
+    # stats subcommand
+    stats_parser = subparsers.add_parser('stats', help='Compare timings of the last run with previous ones')
+    stats_parser.add_argument('name', nargs='*', default=[], help='Artifacts and/or profiles to show(default:all recorded)')
+    stats_parser.add_argument('--baseline-runs', default=5, type=int, help='Number of previous runs to take median of as baseline')
+    stats_parser.set_defaults(func=stats)
+
     # clean subcommand
     clean_parser = subparsers.add_parser('clean', help='Clean up artifacts')
     clean_parser.add_argument('artifact', nargs='?', default='default', help='Artifact to clean')
@@ -169,6 +295,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     global_options.read_global_options(args)
+    if args.trace is not None: tracing.enable(args.trace)
+    if args.privileged_helper: privhelper.start_daemon()
     if global_options.debug():
         logging.basicConfig(level=logging.DEBUG)
         logging.debug("Debug mode enabled")
@@ -176,6 +304,8 @@ if __name__ == "__main__":
     if global_options.base() is not None: 
         upstream.set_base_url(global_options.base())
         logging.info("Base URL set to %s" % global_options.base())
+    upstream.set_download_connections(args.download_connections)
+    upstream.set_offline(args.offline)
     if global_options.workdir() is not None:
         workdir.set(global_options.workdir())
         logging.info("Working directory set to %s" % global_options.workdir())
@@ -1,8 +1,16 @@
-import os,json,subprocess,re,logging
-import workdir,arch,package,genpack_profile,genpack_json,global_options
+import os,sys,stat,time,json,shlex,shutil,subprocess,re,uuid,logging,hashlib,tempfile
+import workdir,arch,package,genpack_profile,genpack_json,global_options,privhelper,timing
 from sudo import sudo
+from privhelper import Tee
+
+def get_container_name():
+    # pid based so that jobs running in parallel(forked) get distinct names
+    return "genpack-artifact-%d" % os.getpid()
+
+def get_machine_cgroup_dir(machine_name):
+    # scope unit systemd-nspawn registers the container as(cgroup v2)
+    return "/sys/fs/cgroup/machine.slice/machine-%s.scope" % machine_name.replace('-', "\\x2d")
 
-CONTAINER_NAME="genpack-artifact-%d" % os.getpid()
 
 class Artifact:
     def __init__(self, artifact):
@@ -64,6 +72,12 @@ class Artifact:
         return self.lookup_build_json("outfile", default_value)
     def get_compression(self, default_value = "gzip"):
         return self.lookup_build_json("compression", default_value)
+    def get_compression_settings(self, compression_override = None):
+        """(compressor, level, block size) with presets and "compressor:level" notation resolved.
+        compression-level and block-size of build.json apply only to the compression build.json specifies"""
+        if compression_override is not None: return resolve_compression(compression_override)
+        #else
+        return resolve_compression(self.get_compression(), self.lookup_build_json("compression-level", None), self.lookup_build_json("block-size", None))
     def get_profile(self, default_profile_name = "default"):
         profile = self.lookup_build_json("profile", None)
         if profile is not None: return genpack_profile.Profile(profile)
@@ -82,6 +96,45 @@ class Artifact:
             for name in files:
                 last_modified = max(last_modified, os.path.getmtime(os.path.join(root, name)))
         return last_modified
+    def get_resolved_build_json(self):
+        if self.build_json is None: return None
+        #else
+        resolved = {key:value for key,value in self.build_json.items() if key != "variants"}
+        if self.active_variant is not None:
+            resolved.update(self.build_json.get("variants", {}).get(self.active_variant, {}))
+        return resolved
+    def get_fingerprint(self):
+        """digest of everything the build result depends on. computed from the inputs only so that it can be taken before the build"""
+        profile = self.get_profile()
+        gentoo_dir = profile.get_gentoo_workdir()
+        h = hashlib.sha256()
+        h.update(json.dumps([self.name, self.active_variant, profile.name, self.get_resolved_build_json(), 
+            sorted(global_options.env_iterate())], sort_keys=True).encode("utf-8"))
+        hash_tree(h, self.artifact_dir)
+        hash_tree(h, profile.get_dir())
+        # pkgdb state. COUNTER changes whenever a package is (re)installed
+        # package dirs of everything in the profile are hashed as the artifact may get any of them
+        pkgs = []
+        pkgdb_dir = os.path.join(gentoo_dir, "var/db/pkg")
+        for category in sorted(os.listdir(pkgdb_dir)):
+            cat_dir = os.path.join(pkgdb_dir, category)
+            if not os.path.isdir(cat_dir): continue
+            #else
+            for pf in sorted(os.listdir(cat_dir)):
+                counter_file = os.path.join(cat_dir, pf, "COUNTER")
+                counter = open(counter_file).read().strip() if os.path.isfile(counter_file) else ""
+                h.update(("\0pkgdb:%s/%s:%s" % (category, pf, counter)).encode("utf-8"))
+                pkgs.append(package.strip_ver("%s/%s" % (category, pf)))
+        for pkg in sorted(set(pkgs)) + sorted(get_all_sets(gentoo_dir, self.get_packages())):
+            h.update(("\0package:%s\0" % pkg).encode("utf-8"))
+            hash_tree(h, package.get_dir(pkg))
+        return h.hexdigest()
+    def get_stored_fingerprint(self):
+        fingerprint_file = os.path.join(self.get_workdir(), ".genpack", "fingerprint")
+        if not os.path.isfile(fingerprint_file): return None
+        #else
+        with open(fingerprint_file) as f:
+            return f.read().strip()
     def get_build_time(self):
         packages_file = os.path.join(self.get_workdir(), ".genpack", "packages")
         if not os.path.isfile(packages_file): return None
@@ -96,12 +149,26 @@ class Artifact:
         if gentoo_workdir_time is None:
             raise Exception("Profile %s must be prepared before checking if artifact %s is up-to-date" % (profile.name, self.name))
         #else
+        if global_options.content_digest():
+            stored_fingerprint = self.get_stored_fingerprint()
+            return stored_fingerprint is not None and stored_fingerprint == self.get_fingerprint()
+        #else
         return build_date > max(gentoo_workdir_time, self.get_last_modified(), package.get_last_modified())
     def is_outfile_up_to_date(self):
         outfile = self.get_outfile()
         if not os.path.isfile(outfile): return False
         #else
+        # a delta image doesn't count. qemu and anything else taking outfile use it alone
+        # newly recorded boot order changes file placement in the image
+        if is_boot_order_newer(self, outfile): return False
+        #else
         return os.path.getmtime(outfile) > self.get_build_time()
+    def get_manifest_file(self):
+        name_and_variant = self.name if self.active_variant is None else "%s:%s" % (self.name, self.active_variant)
+        return os.path.join(workdir.get_arch("index/manifests"), "%s.json" % name_and_variant)
+    def get_boot_order_file(self):
+        name_and_variant = self.name if self.active_variant is None else "%s:%s" % (self.name, self.active_variant)
+        return os.path.join(workdir.get_arch("index/boot-order"), "%s.txt" % name_and_variant)
     def get_all_artifacts():
         artifact_names = genpack_json.get("artifacts", [])
         if not isinstance(artifact_names, list): raise Exception("artifacts must be list")
@@ -117,23 +184,198 @@ class Artifact:
     def get_active_variant(self):
         return self.active_variant
 
-def upper_exec(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, command):
+def get_upper_exec_cmdline(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, command, nspawn_opts=[]):
     variant_args = ["-E", "VARIANT=%s" % variant] if variant is not None else []
     # convert command to list if it is string
     if isinstance(command, str): command = [command]
-    subprocess.check_call(sudo(["systemd-nspawn", "-q", "--suppress-sync=true", "-M", CONTAINER_NAME, "-D", 
+    return ["systemd-nspawn", "-q", "--suppress-sync=true", "-M", get_container_name(), "-D", 
         gentoo_dir, "--overlay=+/:%s:/" % escape_colon(os.path.abspath(upper_dir)), 
         "--bind=%s:/var/cache" % os.path.abspath(cache_dir),
         "--bind-ro=%s:/var/db/repos/gentoo" % os.path.abspath(workdir.get_portage(False)),
         "--capability=CAP_MKNOD",
-        "-E", "PROFILE=%s" % profile.name, "-E", "ARTIFACT=%s" % artifact.name] + variant_args 
-        + global_options.env_as_systemd_nspawn_args()
-        + command))
+        "-E", "PROFILE=%s" % profile.name, "-E", "ARTIFACT=%s" % artifact.name] + variant_args \
+        + global_options.env_as_systemd_nspawn_args() + nspawn_opts \
+        + command
+
+def upper_exec(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, command):
+    subprocess.check_call(sudo(get_upper_exec_cmdline(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, command)))
+
+PKGBUILD_DIR = ".genpack/pkgbuild.d"
+# runs staged pkgbuild scripts in order, stops at the first failure. the scripts are removed when all of them succeeded
+RUN_PKGBUILDS = 'cd / && for pkgbuild in /%s/*; do pkg=${pkgbuild##*/}; pkg=${pkg#*-}; start=$(date +%%s%%N); ' \
+    '"$pkgbuild"; status=$?; if [ $status -ne 0 ]; then echo "pkgbuild of $pkg failed with exit status $status" >&2; exit $status; fi; ' \
+    'echo "pkgbuild of $pkg took $(( ($(date +%%s%%N) - start) / 1000000 ))ms"; done && rm -rf /%s' % (PKGBUILD_DIR, PKGBUILD_DIR)
+
+class StepRunner:
+    """Runs each build step in its own systemd-nspawn invocation"""
+    def __init__(self, gentoo_dir, upper_dir, cache_dir, profile, artifact, variant):
+        self.gentoo_dir = gentoo_dir
+        self.upper_dir = upper_dir
+        self.cache_dir = cache_dir
+        self.profile = profile
+        self.artifact = artifact
+        self.variant = variant
+        self.recorder = timing.Recorder()
+    def __enter__(self):
+        self.recorder.__enter__()
+        return self
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.recorder.__exit__(exception_type, exception_value, traceback)
+        if len(self.recorder.phases) == 0: return
+        #else
+        print("Build steps of %s:" % self.artifact.name)
+        for p in self.recorder.phases:
+            cpu = "%.1f sec" % p["cpu"] if p["cpu"] is not None else "n/a"
+            print("  %-40s %8.1f sec(cpu %s)" % (p["name"], p["wall"], cpu))
+    def timed(self, name, func, *args):
+        with timing.phase(name):
+            return func(*args)
+    def exec(self, command):
+        upper_exec(self.gentoo_dir, self.upper_dir, self.cache_dir, self.profile, self.artifact, self.variant, command)
+    def run(self, name, command):
+        self.timed(name, self.exec, command)
+    def sync_files(self, srcdir, exclude=None):
+        return self.timed("sync %s" % srcdir, sync_files, srcdir, self.upper_dir, exclude)
+    def install_file(self, src, dst):
+        """copy src to dst(relative to root) owned by root, creating leading directories"""
+        mode = stat.S_IMODE(os.stat(src).st_mode) & ~0o022
+        subprocess.check_call(sudo(["install", "-D", "-o", "root", "-g", "root", "-m", "%o" % mode, src, os.path.join(self.upper_dir, dst)]))
+    def enable_services(self, services):
+        if services is None or len(services) == 0: return
+        #else
+        self.timed("enable services", enable_services, self.upper_dir, services)
+
+class BuildContainer(StepRunner):
+    """Keeps one systemd-nspawn instance running throughout the build so that container setup and overlay mount
+    are paid only once. Steps are fed to a shell in the container through stdin and their exit status comes back
+    on stdout following a random token."""
+    CTL_DIR = "/run/genpack/ctl"
+    def __init__(self, gentoo_dir, upper_dir, cache_dir, profile, artifact, variant):
+        super().__init__(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant)
+        self.token = ("genpack-step-done-%s" % uuid.uuid4().hex).encode("utf-8")
+        self.services = None
+        # under workdir rather than /tmp so that files can be staged by hardlink
+        self.ctl_dir = tempfile.mkdtemp(prefix="genpack-ctl-", dir=workdir.get("tmp"))
+        # upper dir must not be modified behind overlayfs. files are staged in ctl dir and copied inside the container
+        binds = ["--bind-ro=%s:%s" % (escape_colon(self.ctl_dir), self.CTL_DIR)]
+        loop = 'while IFS= read -r step; do (eval "$step") </dev/null; echo "%s $?"; done' % self.token.decode("utf-8")
+        try:
+            self.process = subprocess.Popen(sudo(get_upper_exec_cmdline(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, ["sh", "-c", loop], ["--pipe"] + binds)), 
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except BaseException:
+            shutil.rmtree(self.ctl_dir, ignore_errors=True)
+            raise
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.process.stdin.close()
+        self.process.stdout.read()
+        self.process.wait()
+        shutil.rmtree(self.ctl_dir, ignore_errors=True)
+        try:
+            # on upper dir alone like StepRunner, now that the container has gone. the image must not differ by the mode
+            if exception_type is None and self.services is not None:
+                StepRunner.timed(self, "enable services", enable_services, self.upper_dir, self.services)
+        finally:
+            super().__exit__(exception_type, exception_value, traceback)
+    def timed(self, name, func, *args):
+        # the container is reaped only at the end of the build, so rusage of children doesn't tell the cost of a step
+        with timing.phase(name, get_machine_cgroup_dir(get_container_name())):
+            return func(*args)
+    def exec(self, command):
+        if not isinstance(command, str): command = shlex.join(command)
+        if '\n' in command: raise Exception("Build step must be a single line: %s" % command)
+        #else
+        self.process.stdin.write((command + '\n').encode("utf-8"))
+        self.process.stdin.flush()
+        while True:
+            line = self.process.stdout.readline()
+            if line == b'': raise Exception("Build container exited unexpectedly")
+            #else
+            token_pos = line.find(self.token)
+            if token_pos < 0:
+                sys.stdout.buffer.write(line)
+                sys.stdout.buffer.flush()
+                continue
+            #else
+            if token_pos > 0: sys.stdout.buffer.write(line[:token_pos] + b'\n') # output without trailing newline
+            status = int(line[token_pos + len(self.token):])
+            break
+        if status != 0: raise subprocess.CalledProcessError(status, command)
+    def stage(self, src, name):
+        """make src(symlinks resolved on the host) available in the container as CTL_DIR/name"""
+        dst = os.path.join(self.ctl_dir, name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst) # follows symlink
+        except OSError:
+            shutil.copy(src, dst)
+        return os.path.join(self.CTL_DIR, name)
+    def sync_files(self, srcdir, exclude=None):
+        files_to_sync, newest_file = get_files_to_sync(srcdir, exclude)
+        # same as rsync -k: dir symlinks followed, symlinks to files and special files skipped
+        files_to_sync = [f for f in files_to_sync if stat.S_ISREG(os.lstat(os.path.join(srcdir, f)).st_mode)]
+        if len(files_to_sync) == 0: return newest_file
+        #else
+        for f in files_to_sync:
+            self.stage(os.path.join(srcdir, f), os.path.join("stage", f))
+        with open(os.path.join(self.ctl_dir, "files"), "wb") as f:
+            f.write(b''.join([f.encode("utf-8") + b'\0' for f in files_to_sync]))
+        # owned by root, perms masked by umask like rsync without -p
+        self.run("sync %s" % srcdir, "cd %s/stage && xargs -0 -r -a %s/files cp --parents --remove-destination -t /" % (self.CTL_DIR, self.CTL_DIR))
+        shutil.rmtree(os.path.join(self.ctl_dir, "stage"))
+        return newest_file
+    def install_file(self, src, dst):
+        mode = stat.S_IMODE(os.stat(src).st_mode) & ~0o022
+        self.exec(["install", "-D", "-m", "%o" % mode, self.stage(src, "install-file"), os.path.join("/", dst)])
+        os.unlink(os.path.join(self.ctl_dir, "install-file"))
+    def enable_services(self, services):
+        if services is None or len(services) == 0: return
+        #else
+        self.services = services # deferred until the container exits
 
 def escape_colon(s):
     # systemd-nspaws' some options need colon to be escaped
     return re.sub(r':', r'\:', s)
 
+MAX_SYMLINK_HOPS = 40 # same as the kernel's limit
+
+class RootResolver:
+    """Resolves paths within root_dir as if it were /. Everything is lstat'ed only once."""
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.lstat_cache = {}
+    def lstat(self, path):
+        if path not in self.lstat_cache:
+            try:
+                self.lstat_cache[path] = os.lstat(os.path.join(self.root_dir, path))
+            except OSError:
+                self.lstat_cache[path] = None
+        return self.lstat_cache[path]
+    def resolve(self, path):
+        """real path of path relative to root_dir. None if dangling or looping"""
+        resolved = ""
+        components = path.split('/')
+        hops = 0
+        while len(components) > 0:
+            c = components.pop(0)
+            if c in ("", "."): continue
+            if c == "..":
+                resolved = os.path.dirname(resolved) # never goes above root_dir
+                continue
+            #else
+            candidate = os.path.join(resolved, c)
+            st = self.lstat(candidate)
+            if st is None: return None
+            if not stat.S_ISLNK(st.st_mode):
+                resolved = candidate
+                continue
+            #else
+            hops += 1
+            if hops > MAX_SYMLINK_HOPS: return None
+            link = os.readlink(os.path.join(self.root_dir, candidate))
+            if link.startswith('/'): resolved = ""
+            components = link.split('/') + components
+        return resolved
+
 def copy(gentoo_dir, upper_dir, files):
     if not gentoo_dir.endswith('/'): gentoo_dir += '/'
     # files / dirs to shallow copy
@@ -172,14 +414,21 @@ def scan_files(dir):
             files_found.append(os.path.join(root[len(dir) + 1:], f))
     return (files_found, newest_file)
 
-def sync_files(srcdir, dstdir, exclude=None):
+def get_files_to_sync(srcdir, exclude=None):
     files_to_sync, newest_file = scan_files(srcdir)
+    if exclude is not None: files_to_sync = [f for f in files_to_sync if not re.match(exclude, f)]
+    return (files_to_sync, newest_file)
 
-    for f in files_to_sync:
-        if exclude is not None and re.match(exclude, f): continue
-        src = os.path.join(srcdir, f)
-        dst = os.path.join(dstdir, f)
-        subprocess.check_call(sudo(["rsync", "-k", "-R", "--chown=root:root", os.path.join(srcdir, ".", f), dstdir]))
+def sync_files(srcdir, dstdir, exclude=None):
+    files_to_sync, newest_file = get_files_to_sync(srcdir, exclude)
+    if len(files_to_sync) == 0: return newest_file
+    #else
+    # single rsync for whole the dir. --files-from implies -R(paths are relative to srcdir)
+    if not srcdir.endswith('/'): srcdir += '/'
+    rsync = subprocess.Popen(sudo(["rsync", "-k", "--chown=root:root", "--from0", "--files-from=-", srcdir, dstdir]), stdin=subprocess.PIPE)
+    rsync.stdin.write(b''.join([f.encode("utf-8") + b'\0' for f in files_to_sync]))
+    rsync.stdin.close()
+    if rsync.wait() != 0: raise BaseException("rsync returned error code.")
     
     return newest_file
 
@@ -187,7 +436,7 @@ def enable_services(root_dir, services):
     if services is None: return
     if not isinstance(services, list): services = [services]
     if len(services) == 0: return
-    subprocess.check_call(sudo(["systemd-nspawn", "-q", "--suppress-sync=true", "-M", CONTAINER_NAME, "-D", root_dir, "systemctl", "enable"] + services))
+    subprocess.check_call(sudo(["systemd-nspawn", "-q", "--suppress-sync=true", "-M", get_container_name(), "-D", root_dir, "systemctl", "enable"] + services))
 
 def get_masked_packages(gentoo_dir) -> set:
     masked_packages = set()
@@ -216,78 +465,341 @@ def get_all_sets(gentoo_dir, pkgs, sets=None):
             get_all_sets(gentoo_dir, sub_sets, sets)
     return list(sets)
 
-def build(artifact):
+def read_packages(upper_dir):
+    pkgs = []
+    with open(os.path.join(upper_dir, ".genpack/packages")) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line[0] == '#': continue
+            #else
+            # remove trailing [...] from line
+            line = re.sub(r'\[.*\]$', "", line)
+            pkgs.append(line)
+    return pkgs
+
+def hash_tree(h, dir):
+    if not os.path.isdir(dir): return
+    #else
+    visited = set()
+    for root,dirs,files in os.walk(dir, followlinks=True):
+        st = os.stat(root)
+        if (st.st_dev, st.st_ino) in visited: # symlink loop or the same dir linked twice
+            dirs.clear()
+            continue
+        #else
+        visited.add((st.st_dev, st.st_ino))
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            h.update(("\0%s:%o\0" % (path[len(dir) + 1:], os.lstat(path).st_mode)).encode("utf-8"))
+            if os.path.islink(path):
+                h.update(os.readlink(path).encode("utf-8"))
+                continue
+            #else
+            with open(path, "rb") as src:
+                while chunk := src.read(1024 * 1024):
+                    h.update(chunk)
+
+def build(artifact, persistent_container = False):
     upper_dir = artifact.get_workdir()
     workdir.move_to_trash(upper_dir, True)
     os.makedirs(os.path.dirname(upper_dir), exist_ok=True)
-    subprocess.check_call(sudo(["mkdir", upper_dir]))
+    privhelper.mkdir([upper_dir])
     profile = artifact.get_profile()
+    # taken before the build so that input changes during the build make the result out of date
+    fingerprint = artifact.get_fingerprint()
     
     gentoo_dir = profile.get_gentoo_workdir()
     cache_dir = profile.get_cache_workdir()
-
-    print("Copying files to artifact dir...")
-    cmdline = ["/usr/bin/copyup-packages", "--bind-mount-root", "--toplevel-dirs", "--exec-package-scripts"]
-    cmdline += ["--generate-metadata"]
-    if artifact.is_devel(): cmdline += ["--devel"]
-    for dep_removal in artifact.get_dep_removals():
-        cmdline += ["--dep-removal", dep_removal]
-    artifact_packages = artifact.get_packages()
-    cmdline += artifact_packages
     variant = artifact.get_active_variant()
-    upper_exec(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, cmdline)
 
-    # per-package setup
-    pkgs = []
-    with open(os.path.join(upper_dir, ".genpack/packages")) as f:
+    step_runner_class = BuildContainer if persistent_container else StepRunner
+    with step_runner_class(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant) as step_runner:
+        print("Copying files to artifact dir...")
+        cmdline = ["/usr/bin/copyup-packages", "--bind-mount-root", "--toplevel-dirs", "--exec-package-scripts"]
+        cmdline += ["--generate-metadata"]
+        if artifact.is_devel(): cmdline += ["--devel"]
+        for dep_removal in artifact.get_dep_removals():
+            cmdline += ["--dep-removal", dep_removal]
+        artifact_packages = artifact.get_packages()
+        cmdline += artifact_packages
+        step_runner.run("copyup-packages", cmdline)
+
+        # per-package setup
+        pkgs = read_packages(upper_dir)
+        # get sets from artifact_packages
+        pkgs += get_all_sets(gentoo_dir, artifact_packages)
+
+        newest_pkg_file = 0
+        num_pkgbuilds = 0
+        for pkg in pkgs:
+            pkg_wo_ver = pkg if pkg[0] == '@' else package.strip_ver(pkg)
+            package_dir = package.get_dir(pkg_wo_ver)
+            if not os.path.isdir(package_dir): continue
+            #else
+            print("Processing package %s..." % pkg_wo_ver)
+            newest_pkg_file = max(newest_pkg_file, step_runner.sync_files(package_dir, r"^(CONTENTS(\.|$)|pkgbuild$)"))
+            pkgbuild = os.path.join(package_dir, "pkgbuild")
+            if os.path.isfile(pkgbuild):
+                # staged under distinct name to run all of them at once later
+                step_runner.install_file(pkgbuild, os.path.join(PKGBUILD_DIR, "%04d-%s" % (num_pkgbuilds, pkg_wo_ver.replace('/', '_'))))
+                num_pkgbuilds += 1
+        if num_pkgbuilds > 0:
+            step_runner.run("pkgbuild", ["sh", "-c", RUN_PKGBUILDS])
+
+        # artifact specific setup
+        newest_artifact_file = max(newest_pkg_file, step_runner.sync_files(artifact.get_dir()))
+        if os.path.isfile(os.path.join(upper_dir, "build")):
+            print("Building artifact...")
+            step_runner.run("build", "/build")
+        else:
+            print("Artifact build script not found.")
+
+        # enable services
+        step_runner.enable_services(artifact.get_services())
+
+    privhelper.rm([os.path.join(upper_dir, "build"), 
+                   os.path.join(upper_dir, "build.json"), 
+                   os.path.join(upper_dir, "usr/src"),
+                   os.path.join(upper_dir, "etc/resolv.conf")])
+
+    # record digest of the inputs for --content-digest
+    with Tee(os.path.join(upper_dir, ".genpack/fingerprint")) as f:
+        f.write((fingerprint + '\n').encode("utf-8"))
+
+def save_timings(artifact, recorder, kind):
+    """append timings to history. build timings are also stored in the artifact as .genpack/timings.json"""
+    name_and_variant = artifact.name if artifact.active_variant is None else "%s:%s" % (artifact.name, artifact.active_variant)
+    recorder.save("artifacts", name_and_variant, kind)
+    if kind != "build": return
+    #else
+    with Tee(os.path.join(artifact.get_workdir(), ".genpack/timings.json")) as f:
+        f.write(json.dumps(recorder.phases, indent=2).encode("utf-8"))
+
+COMPRESSORS = ("gzip", "xz", "zstd", "lzo", "lz4", "none")
+COMPRESSION_LEVELS = {"gzip": (1, 9), "zstd": (1, 22), "lzo": (1, 9)}
+COMPRESSION_PRESETS = {
+    "fast-build": {"compression": "zstd", "compression-level": 1, "block-size": "128K"},
+    "small-image": {"compression": "xz", "block-size": "1M"},
+    # zstd decompresses equally fast at any level and small blocks mean less read amplification on random access
+    "fast-boot": {"compression": "zstd", "compression-level": 19, "block-size": "128K"},
+}
+
+def resolve_compression(compression, level = None, block_size = None):
+    """compression is a preset name, compressor name or "compressor:level".
+    level and block_size(from build.json) apply to compressor name only. presets are used as defined"""
+    preset = COMPRESSION_PRESETS.get(compression)
+    if preset is not None: return resolve_compression(preset["compression"], preset.get("compression-level"), preset.get("block-size"))
+    #else
+    compressor = compression
+    if ':' in compressor: compressor, level = compressor.split(':', 1)
+    if compressor not in COMPRESSORS: raise BaseException("Unknown compression type %s" % compressor)
+    #else
+    if block_size is None and compressor == "xz": block_size = "1M"
+    if level is None: return (compressor, 1 if compressor == "gzip" else None, block_size) # gzip defaults to fastest
+    #else
+    if compressor not in COMPRESSION_LEVELS: raise Exception("Compression level cannot be specified for %s" % compressor)
+    #else
+    min_level, max_level = COMPRESSION_LEVELS[compressor]
+    if not str(level).isdigit() or int(level) < min_level or int(level) > max_level:
+        raise Exception("Compression level of %s must be %d-%d" % (compressor, min_level, max_level))
+    #else
+    return (compressor, int(level), block_size)
+
+def get_mksquashfs_compression_options(compressor, level, block_size):
+    options = ["-no-compression"] if compressor == "none" else ["-comp", compressor]
+    if level is not None: options += ["-Xcompression-level", str(level)]
+    if block_size is not None: options += ["-b", str(block_size)]
+    return options
+
+SORT_PRIORITY_MAX = 32767 # mksquashfs places files with higher priority first
+
+STRACE_SYSCALLS = ["execve", "execveat", "open", "openat", "openat2", "pivot_root", "chroot"]
+
+def parse_strace_log(log, root_dir):
+    """paths(absolute within root_dir) opened or executed in strace -f output, in the order of first access.
+    a process is considered to be in the container once it or its ancestor has switched root. as pids of
+    the container's processes are not known beforehand, processes first seen after the switch count as inside.
+    processes outside(systemd-nspawn itself) count only when they access files under root_dir"""
+    root_dir = os.path.abspath(root_dir)
+    paths = {}
+    inside = set()
+    seen = set()
+    switched = False
+    with open(log, errors="surrogateescape") as f:
         for line in f:
-            line = line.strip()
-            if line == "" or line[0] == '#': continue
+            pid, _, call = line.partition(' ')
+            if not pid.isdigit(): continue
             #else
-            # remove trailing [...] from line
-            line = re.sub(r'\[.*\]$', "", line)
-            pkgs.append(line)
-    # get sets from artifact_packages
-    pkgs += get_all_sets(gentoo_dir, artifact_packages)
+            if pid not in seen:
+                seen.add(pid)
+                if switched: inside.add(pid)
+            if re.match(r'\s*(?:(?:pivot_root|chroot)\(|<\.\.\. (?:pivot_root|chroot) resumed>).*= 0$', call.rstrip('\n')):
+                inside.add(pid)
+                switched = True
+                continue
+            #else
+            match = re.search(r'\b(?:execve|execveat|open|openat|openat2)\((?:[^",]+, )?"((?:[^"\\]|\\.)*)"', call)
+            if match is None: continue
+            #else
+            path = match.group(1).encode("latin-1", "surrogateescape").decode("unicode_escape").encode("latin-1").decode("utf-8", "surrogateescape")
+            if not path.startswith('/'): continue
+            #else
+            if pid not in inside:
+                if not path.startswith(root_dir + '/'): continue # host side file
+                #else
+                path = path[len(root_dir):]
+            paths[path] = True
+    return list(paths.keys())
 
-    newest_pkg_file = 0
-    for pkg in pkgs:
-        pkg_wo_ver = pkg if pkg[0] == '@' else package.strip_ver(pkg)
-        package_dir = package.get_dir(pkg_wo_ver)
-        if not os.path.isdir(package_dir): continue
+def save_boot_order(artifact, paths):
+    """keep regular files among paths(symlinks resolved within artifact's root) as boot order of artifact"""
+    resolver = RootResolver(artifact.get_workdir())
+    files = {}
+    for path in paths:
+        resolved = resolver.resolve(path.lstrip('/'))
+        if resolved is None or resolved == "" or re.search(r'\s', resolved): continue # sort file can't have whitespace in path
         #else
-        print("Processing package %s..." % pkg_wo_ver)
-        newest_pkg_file = max(newest_pkg_file, sync_files(package_dir, upper_dir, r"^CONTENTS(\.|$)"))
-        if os.path.isfile(os.path.join(upper_dir, "pkgbuild")):
-            upper_exec(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, ["sh", "-c", "/pkgbuild && rm -f /pkgbuild"])
-
-    # artifact specific setup
-    newest_artifact_file = max(newest_pkg_file, sync_files(artifact.get_dir(), upper_dir))
-    if os.path.isfile(os.path.join(upper_dir, "build")):
-        print("Building artifact...")
-        upper_exec(gentoo_dir, upper_dir, cache_dir, profile, artifact, variant, "/build")
-    else:
-        print("Artifact build script not found.")
+        st = resolver.lstat(resolved)
+        if st is not None and stat.S_ISREG(st.st_mode): files[resolved] = True
+    boot_order_file = artifact.get_boot_order_file()
+    with open(boot_order_file, "w") as f:
+        f.write(''.join([path + '\n' for path in files.keys()]))
+    print("Boot order of %d files recorded to %s." % (len(files), boot_order_file))
 
-    # enable services
-    enable_services(upper_dir, artifact.get_services())
+def read_boot_order(artifact):
+    boot_order_file = artifact.get_boot_order_file()
+    if not os.path.isfile(boot_order_file): return []
+    #else
+    with open(boot_order_file) as f:
+        return [line.rstrip('\n') for line in f if line.strip() != ""]
 
-    subprocess.check_call(sudo(["rm", "-rf", 
-                                os.path.join(upper_dir, "build"), 
-                                os.path.join(upper_dir, "build.json"), 
-                                os.path.join(upper_dir, "usr/src"),
-                                os.path.join(upper_dir, "etc/resolv.conf")]))
+def is_boot_order_newer(artifact, outfile):
+    """True if boot order has been recorded after outfile was packed"""
+    boot_order_file = artifact.get_boot_order_file()
+    return os.path.isfile(boot_order_file) and os.path.isfile(outfile) and os.path.getmtime(boot_order_file) >= os.path.getmtime(outfile)
 
-def pack(artifact, outfile=None, compression=None):
-    if outfile is None: outfile = artifact.get_outfile()
-    if compression is None: compression = artifact.get_compression()
-    cmdline = ["mksquashfs", artifact.get_workdir(), outfile, "-noappend", "-no-exports"]
-    if compression == "xz": cmdline += ["-comp", "xz", "-b", "1M"]
-    elif compression == "gzip": cmdline += ["-Xcompression-level", "1"]
-    elif compression == "lzo": cmdline += ["-comp", "lzo"]
-    elif compression == "none": cmdline += ["-no-compression"]
-    else: raise BaseException("Unknown compression type %s" % compression)
+DELTA_MAX_RATIO = 0.25 # full repack if more than this portion of the image content has changed
+
+def get_delta_outfile(outfile):
+    return re.sub(r'\.squashfs$', '', outfile) + ".delta.squashfs"
+
+def mksquashfs(artifact, srcdir, outfile, compression, sort_file = None):
+    cmdline = ["mksquashfs", srcdir, outfile, "-noappend", "-no-exports"]
+    if sort_file is not None: cmdline += ["-sort", sort_file]
+    cmdline += get_mksquashfs_compression_options(*artifact.get_compression_settings(compression))
     cpus = global_options.cpus()
     if cpus is not None: cmdline += ["-processors", str(cpus)]
-    subprocess.check_call(sudo(cmdline))
-    subprocess.check_call(sudo(["chown", "%d:%d" % (os.getuid(), os.getgid()), outfile]))
+    with timing.phase("mksquashfs"):
+        subprocess.check_call(sudo(cmdline))
+    privhelper.chown(outfile, os.getuid(), os.getgid())
+
+def get_image_id(outfile):
+    st = os.stat(outfile)
+    return [os.path.abspath(outfile), st.st_size, st.st_mtime_ns]
+
+def diff_manifests(base, current):
+    """"+path" for entries added or changed, "-path" for entries removed"""
+    changes = []
+    for path, entry in current.items():
+        base_entry = base.get(path)
+        # mtime alone doesn't matter as long as the content is the same
+        if base_entry is None or base_entry[0:3] != entry[0:3] or base_entry[5] != entry[5]: changes.append("+" + path)
+    for path in base:
+        if path in current: continue
+        #else
+        parent = os.path.dirname(path)
+        # no need to whiteout children of removed(or replaced) directory
+        if parent != "" and (parent not in current or not stat.S_ISDIR(current[parent][0])): continue
+        #else
+        changes.append("-" + path)
+    return changes
+
+def pack_delta(artifact, outfile, compression):
+    """pack only what has changed since outfile was packed into a delta image which is to be stacked on outfile.
+    returns False if full repack is needed instead"""
+    manifest_file = artifact.get_manifest_file()
+    if not os.path.isfile(outfile) or not os.path.isfile(manifest_file): return False
+    #else
+    with open(manifest_file) as f:
+        base_manifest = json.load(f)
+    if base_manifest.get("image") != get_image_id(outfile): return False # outfile has been replaced
+    #else
+    upper_dir = artifact.get_workdir()
+    with timing.phase("manifest"):
+        manifest = privhelper.run("manifest", [upper_dir, manifest_file], [])
+    changes = diff_manifests(base_manifest["files"], manifest)
+    changed_bytes = sum(manifest[c[1:]][3] for c in changes if c[0] == '+')
+    total_bytes = sum(entry[3] for entry in manifest.values())
+    if changed_bytes > total_bytes * DELTA_MAX_RATIO:
+        print("Too many changes for incremental repack.")
+        return False
+    #else
+    staging_dir = workdir.get_arch("delta/%s" % os.path.basename(upper_dir), False)
+    workdir.move_to_trash(staging_dir, True)
+    os.makedirs(os.path.dirname(staging_dir), exist_ok=True)
+    privhelper.mkdir([staging_dir])
+    privhelper.run("stage-delta", [upper_dir, staging_dir], changes)
+    delta_outfile = get_delta_outfile(outfile)
+    mksquashfs(artifact, staging_dir, delta_outfile, compression)
+    workdir.move_to_trash(staging_dir)
+    print("%d changes(%d bytes) packed into %s." % (len(changes), changed_bytes, delta_outfile))
+    print("Note: %s is not up-to-date by itself. The delta must be stacked on it by a loader which supports it." % outfile)
+    return True
+
+def pack(artifact, outfile=None, compression=None, incremental=False):
+    if outfile is None: outfile = artifact.get_outfile()
+    # a delta can't move files already in outfile to follow newly recorded boot order
+    if incremental and not is_boot_order_newer(artifact, outfile) and pack_delta(artifact, outfile, compression): return
+    #else
+    boot_order = read_boot_order(artifact)
+    if len(boot_order) > 0:
+        # files accessed during boot are placed first in the order they were accessed
+        print("Placing %d files in recorded boot order." % len(boot_order))
+        with tempfile.NamedTemporaryFile("w", suffix=".sort") as sort_file:
+            sort_file.write(''.join(["%s %d\n" % (path, max(SORT_PRIORITY_MAX - i, 1)) for i, path in enumerate(boot_order)]))
+            sort_file.flush()
+            mksquashfs(artifact, artifact.get_workdir(), outfile, compression, sort_file.name)
+    else:
+        mksquashfs(artifact, artifact.get_workdir(), outfile, compression)
+    delta_outfile = get_delta_outfile(outfile)
+    if os.path.exists(delta_outfile): os.unlink(delta_outfile) # it was relative to the previous image
+    if not incremental: return
+    #else
+    # manifest for the next incremental repack
+    manifest_file = artifact.get_manifest_file()
+    with timing.phase("manifest"):
+        manifest = privhelper.run("manifest", [artifact.get_workdir(), manifest_file], [])
+    tmpfile = "%s.%d.tmp" % (manifest_file, os.getpid())
+    with open(tmpfile, "w") as f:
+        json.dump({"image": get_image_id(outfile), "files": manifest}, f)
+    os.replace(tmpfile, manifest_file)
+
+def bench_pack(artifact, compressions):
+    """pack artifact with each of compressions and measure pack time, image size and random read throughput.
+    returns list of (compression, seconds to pack, image size, bytes read, seconds to read)"""
+    bench_dir = workdir.get_arch("bench")
+    results = []
+    for compression in compressions:
+        outfile = os.path.join(bench_dir, "%s.squashfs" % compression.replace(':', '-'))
+        print("Packing with %s..." % compression)
+        start_time = time.time()
+        pack(artifact, outfile, compression)
+        pack_time = time.time() - start_time
+        image_size = os.path.getsize(outfile)
+        mountpoint = tempfile.mkdtemp(dir=bench_dir)
+        loop_device = None
+        try:
+            # direct I/O so that reads of the image just written are not served from the page cache
+            loop_device = subprocess.check_output(sudo(["losetup", "--find", "--show", "--read-only", "--direct-io=on", outfile])).decode("utf-8").strip()
+            subprocess.check_call(sudo(["mount", "-t", "squashfs", "-o", "ro", loop_device, mountpoint]))
+            try:
+                read_bytes, read_time = privhelper.run("random-read", [mountpoint, "0"], [])
+            finally:
+                subprocess.check_call(sudo(["umount", mountpoint]))
+        finally:
+            if loop_device is not None: subprocess.call(sudo(["losetup", "-d", loop_device]))
+            os.rmdir(mountpoint)
+            os.unlink(outfile)
+        results.append((compression, pack_time, image_size, read_bytes, read_time))
+    return results
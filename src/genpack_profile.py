@@ -1,8 +1,11 @@
-import os,subprocess,glob,logging,time
-import workdir,user_dir,upstream,genpack_json,global_options
+import os,stat,shutil,subprocess,logging,time
+import workdir,user_dir,upstream,genpack_json,global_options,privhelper,timing
 from sudo import sudo
 
-CONTAINER_NAME="genpack-profile-%d" % os.getpid()
+def get_container_name():
+    # pid based so that jobs running in parallel(forked) get distinct names
+    return "genpack-profile-%d" % os.getpid()
+
 _extract_portage_done = False
 _pull_overlay_done = False
 
@@ -21,7 +24,9 @@ class Profile:
     def get_workdir(self):
         return workdir.get_profile(self.name)
     def get_gentoo_workdir(self):
-        return workdir.get_profile(self.name, "root")
+        gentoo_dir = workdir.get_profile(self.name, "root")
+        mount_shared_stage3(gentoo_dir)
+        return gentoo_dir
     def get_cache_workdir(self):
         return workdir.get_profile(self.name, "cache")
     def get_latest_pkgdb_timestamp(self):
@@ -74,7 +79,7 @@ class Profile:
         return os.path.isdir(os.path.join(".", "profiles", profile_name))
 
 def lower_exec(lower_dir, cache_dir, portage_dir, cmdline, nspawn_opts=[]):
-    nspawn_cmdline = ["systemd-nspawn", "-q", "--suppress-sync=true", "-M", CONTAINER_NAME, "-D", lower_dir, 
+    nspawn_cmdline = ["systemd-nspawn", "-q", "--suppress-sync=true", "-M", get_container_name(), "-D", lower_dir, 
         "--bind=%s:/var/cache" % os.path.abspath(cache_dir),
         "--capability=CAP_MKNOD,CAP_SYS_ADMIN",
         "--bind-ro=%s:/var/db/repos/gentoo" % os.path.abspath(portage_dir)
@@ -97,7 +102,8 @@ def extract_portage():
     _extract_portage_done = True
     with user_dir.portage_tarball() as portage_tarball:
         portage_dir = workdir.get_portage(True)
-        upstream.download_if_necessary(upstream.get_latest_portage_tarball_url(), portage_tarball)
+        with timing.phase("download portage"):
+            upstream.download_if_necessary(upstream.get_latest_portage_tarball_url(), portage_tarball)
 
         # if portage is up-to-date, do nothing
         done_file = os.path.join(portage_dir, ".done")
@@ -115,40 +121,210 @@ def extract_portage():
 
         print("Extracting portage into %s..." % portage_dir)
         os.makedirs(portage_dir)
-        subprocess.check_call(sudo(["tar", "xpf", portage_tarball, "--strip-components=1", "-C", portage_dir]))
+        with timing.phase("extract portage"):
+            extract_tarball(portage_tarball, [portage_dir], ["--strip-components=1"])
         with open(done_file, "w") as f:
             f.write(str(tarball_timestamp))
 
-def extract_stage3(root_dir, variant = "systemd"):
-    stage3_done_file = os.path.join(root_dir, ".stage3-done")
-    with user_dir.stage3_tarball(variant) as stage3_tarball:
-        upstream.download_if_necessary(upstream.get_latest_stage3_tarball_url(variant), stage3_tarball)
-        if os.path.exists(stage3_done_file) and os.stat(stage3_done_file).st_mtime > os.stat(stage3_tarball).st_mtime:
-            return False # stage3 already extracted
+STAGE3_TAR_ARGS = ["--strip-components=1", "--exclude=./dev/*"]
+_fresh_stage3_roots = set()
 
-        workdir.move_to_trash(root_dir)
-        os.makedirs(root_dir)
-        print("Extracting stage3...")
-        subprocess.check_call(sudo(["tar", "xpf", stage3_tarball, "--strip-components=1", "--exclude=./dev/*", "-C", root_dir]))
+def is_multiblock_xz(tarball):
+    """multi-threaded xz decompression works only for archives consisting of multiple blocks"""
+    if not tarball.endswith(".xz") or shutil.which("xz") is None: return False
+    #else
+    try:
+        output = subprocess.check_output(["xz", "--robot", "--list", tarball]).decode("utf-8")
+    except subprocess.CalledProcessError:
+        return False
+    for line in output.splitlines():
+        columns = line.split('\t')
+        if columns[0] == "file" and len(columns) > 2: return int(columns[2]) > 1
+    #else
+    return False
 
+def extract_tarball(tarball, dest_dirs, tar_args = []):
+    """extract tarball into each of dest_dirs with single decompression pass"""
+    multiblock = is_multiblock_xz(tarball)
+    if not multiblock and (len(dest_dirs) == 1 or not tarball.endswith(".xz")):
+        for dest_dir in dest_dirs:
+            subprocess.check_call(sudo(["tar", "xpf", tarball] + tar_args + ["-C", dest_dir]))
+        return
+    #else
+    decompressor = subprocess.Popen(["xz", "-dc"] + (["-T0"] if multiblock else []) + [tarball], stdout=subprocess.PIPE)
+    if len(dest_dirs) == 1:
+        tars = [subprocess.Popen(sudo(["tar", "xpf", "-"] + tar_args + ["-C", dest_dirs[0]]), stdin=decompressor.stdout)]
+        decompressor.stdout.close()
+    else:
+        tars = [subprocess.Popen(sudo(["tar", "xpf", "-"] + tar_args + ["-C", dest_dir]), stdin=subprocess.PIPE) for dest_dir in dest_dirs]
+        try:
+            while chunk := decompressor.stdout.read(1024 * 1024):
+                for tar in tars: tar.stdin.write(chunk)
+            for tar in tars: tar.stdin.close()
+        except BrokenPipeError: # one of tars has died. the rest must not wait for input forever
+            for process in [decompressor] + tars:
+                if process.stdin is not None:
+                    try:
+                        process.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                process.kill()
+            for process in [decompressor] + tars: process.wait()
+            raise Exception("Extracting %s failed" % tarball)
+    if decompressor.wait() != 0: raise Exception("Decompressing %s failed" % tarball)
+    for tar in tars:
+        if tar.wait() != 0: raise Exception("Extracting %s failed" % tarball)
+
+def is_stage3_extracted(root_dir, stage3_tarball):
+    stage3_done_file = os.path.join(root_dir, ".stage3-done")
+    return os.path.exists(stage3_done_file) and os.stat(stage3_done_file).st_mtime > os.stat(stage3_tarball).st_mtime
+
+def setup_stage3(root_dir):
     kernel_config_dir = os.path.join(root_dir, "etc/kernels")
     repos_dir = os.path.join(root_dir, "var/db/repos/gentoo")
-    subprocess.check_call(sudo(["mkdir", "-p", kernel_config_dir, repos_dir]))
+    privhelper.mkdir([kernel_config_dir, repos_dir], parents=True)
     subprocess.check_call(sudo(["chmod", "-R", "o+rw", 
         os.path.join(root_dir, "etc/portage"), os.path.join(root_dir, "usr/src"), 
         os.path.join(root_dir, "var/db/repos"), os.path.join(root_dir, "var/cache"), 
         kernel_config_dir, os.path.join(root_dir, "usr/local")]))
     with open(os.path.join(root_dir, "etc/portage/make.conf"), "a") as f:
         f.write('FEATURES="-sandbox -usersandbox -network-sandbox"\n')
-    with open(stage3_done_file, "w") as f:
+    with open(os.path.join(root_dir, ".stage3-done"), "w") as f:
         pass
+    _fresh_stage3_roots.add(root_dir)
+
+def download_stage3(stage3_tarball, variant = "systemd"):
+    with timing.phase("download stage3"):
+        stage3_tarball_url = upstream.get_latest_stage3_tarball_url(variant)
+        upstream.download_if_necessary(stage3_tarball_url, stage3_tarball, 
+            stage3_tarball_url + ".DIGESTS" if stage3_tarball_url is not None else None)
+
+def get_shared_stage3_dir(variant = "systemd"):
+    return workdir.get_arch(os.path.join("stage3", variant), False)
+
+def prepare_shared_stage3(variant = "systemd"):
+    base_dir = get_shared_stage3_dir(variant)
+    with user_dir.stage3_tarball(variant) as stage3_tarball:
+        download_stage3(stage3_tarball, variant)
+        if is_stage3_extracted(base_dir, stage3_tarball): return base_dir
+        #else
+        # profiles stacked on the old base must not keep using it
+        workdir.unmount_all(workdir.get_arch("profiles", False))
+        workdir.move_to_trash(base_dir, True)
+        os.makedirs(base_dir)
+        print("Extracting stage3 into shared base %s..." % base_dir)
+        with timing.phase("extract stage3"):
+            extract_tarball(stage3_tarball, [base_dir], STAGE3_TAR_ARGS)
+        # .stage3-done must be written before releasing the lock, or another job would take base_dir as half extracted
+        setup_stage3(base_dir)
+    return base_dir
+
+def get_stage3_base_stamp(root_dir):
+    """mode and base mtime recorded when root_dir was populated from shared stage3. None if it wasn't"""
+    stamp_file = os.path.join(os.path.dirname(root_dir), ".stage3-base")
+    if not os.path.isfile(stamp_file): return None
+    #else
+    with open(stamp_file) as f:
+        return f.read()
+
+def mount_stage3_overlay(root_dir, base_dir):
+    profile_workdir = os.path.dirname(root_dir)
+    subprocess.check_call(sudo(["mount", "-t", "overlay", "overlay", "-o", "lowerdir=%s,upperdir=%s,workdir=%s" 
+        % (base_dir, os.path.join(profile_workdir, "upper"), os.path.join(profile_workdir, "overlay-work")), root_dir]))
+
+def mount_shared_stage3(root_dir, variant = "systemd"):
+    """mount overlay of root_dir again if it has gone(e.g. by reboot) while its base is still the same"""
+    if os.path.ismount(root_dir) or not os.path.isdir(root_dir): return
+    #else
+    stamp = get_stage3_base_stamp(root_dir)
+    if stamp is None or not stamp.startswith("overlay:"): return
+    #else
+    base_dir = get_shared_stage3_dir(variant)
+    base_done_file = os.path.join(base_dir, ".stage3-done")
+    # base has been replaced. populate_from_shared_stage3() will recreate root_dir
+    if not os.path.isfile(base_done_file) or stamp != "overlay:%s" % os.stat(base_done_file).st_mtime: return
+    #else
+    mount_stage3_overlay(root_dir, base_dir)
+
+def populate_from_shared_stage3(root_dir, mode, variant = "systemd"):
+    """make root_dir an overlayfs on top of shared stage3 base(mode="overlay") or a reflink copy of it(mode="reflink").
+    returns True if root_dir has been (re)created"""
+    if mode not in ("overlay", "reflink"): raise Exception("Unknown shared stage3 mode: %s" % mode)
+    #else
+    base_dir = prepare_shared_stage3(variant)
+    profile_workdir = os.path.dirname(root_dir)
+    stamp_file = os.path.join(profile_workdir, ".stage3-base")
+    base_stamp = "%s:%s" % (mode, os.stat(os.path.join(base_dir, ".stage3-done")).st_mtime)
+    fresh = get_stage3_base_stamp(root_dir) != base_stamp or not os.path.isdir(root_dir)
+    upper_dir = os.path.join(profile_workdir, "upper")
+    overlay_work_dir = os.path.join(profile_workdir, "overlay-work")
+    if fresh:
+        for d in [root_dir, upper_dir, overlay_work_dir]: workdir.move_to_trash(d, True)
+        os.makedirs(root_dir)
+
+    if mode == "overlay":
+        if fresh:
+            os.makedirs(upper_dir)
+            os.makedirs(overlay_work_dir)
+        if not os.path.ismount(root_dir): mount_stage3_overlay(root_dir, base_dir)
+    elif fresh:
+        print("Copying shared stage3 into %s..." % root_dir)
+        subprocess.check_call(sudo(["cp", "-a", "--reflink=auto", os.path.join(base_dir, "."), root_dir]))
+
+    if fresh:
+        with open(stamp_file, "w") as f:
+            f.write(base_stamp)
+        _fresh_stage3_roots.add(root_dir)
+    return fresh
+
+def extract_stage3(root_dir, variant = "systemd"):
+    shared_stage3 = global_options.shared_stage3()
+    if shared_stage3 is not None: return populate_from_shared_stage3(root_dir, shared_stage3, variant)
+    #else
+    stamp = get_stage3_base_stamp(root_dir)
+    if stamp is not None:
+        # root_dir was populated from shared stage3 previously. keep it in the same mode rather than throwing it away
+        return populate_from_shared_stage3(root_dir, stamp.partition(':')[0], variant)
+    #else
+    with user_dir.stage3_tarball(variant) as stage3_tarball:
+        download_stage3(stage3_tarball, variant)
+        if is_stage3_extracted(root_dir, stage3_tarball):
+            return root_dir in _fresh_stage3_roots # True if extracted by extract_stage3_for_profiles()
+
+        workdir.move_to_trash(root_dir, True)
+        os.makedirs(root_dir)
+        print("Extracting stage3...")
+        with timing.phase("extract stage3"):
+            extract_tarball(stage3_tarball, [root_dir], STAGE3_TAR_ARGS)
+        setup_stage3(root_dir)
     return True
 
+def extract_stage3_for_profiles(profiles, variant = "systemd"):
+    """extract stage3 into all profiles which need fresh one at once, decompressing the tarball only once"""
+    if global_options.shared_stage3() is not None: return # extracted only once anyway
+    with user_dir.stage3_tarball(variant) as stage3_tarball:
+        download_stage3(stage3_tarball, variant)
+        root_dirs = [profile.get_gentoo_workdir() for profile in profiles]
+        # roots populated from shared stage3 are left to extract_stage3()
+        root_dirs = [root_dir for root_dir in root_dirs if get_stage3_base_stamp(root_dir) is None and not is_stage3_extracted(root_dir, stage3_tarball)]
+        if len(root_dirs) < 2: return # nothing to share
+        #else
+        for root_dir in root_dirs:
+            workdir.move_to_trash(root_dir)
+            os.makedirs(root_dir)
+        print("Extracting stage3 into %d profiles..." % len(root_dirs))
+        with timing.phase("extract stage3"):
+            extract_tarball(stage3_tarball, root_dirs, STAGE3_TAR_ARGS)
+        for root_dir in root_dirs:
+            setup_stage3(root_dir)
+
 def sync_overlay(root_dir, overlay_url = "https://github.com/wbrxcorp/genpack-overlay.git"):
     with user_dir.overlay_dir() as overlay_dir:
         global _pull_overlay_done
         if not _pull_overlay_done:
-            if os.path.exists(os.path.join(overlay_dir, ".git")):
+            if upstream.is_offline() and os.path.exists(os.path.join(overlay_dir, ".git")):
+                print("Offline mode. Using genpack-overlay as is")
+            elif os.path.exists(os.path.join(overlay_dir, ".git")):
                 print("Syncing genpack-overlay...")
                 if subprocess.call(["git", "-C", overlay_dir, "pull"]) != 0:
                     print("Failed to pull genpack-overlay, proceeding without sync")
@@ -158,7 +334,7 @@ def sync_overlay(root_dir, overlay_url = "https://github.com/wbrxcorp/genpack-ov
             _pull_overlay_done = True
         subprocess.check_call(sudo(["rsync", "-a", "--delete", overlay_dir, os.path.join(root_dir, "var/db/repos/")]))
     if not os.path.exists(os.path.join(root_dir, "etc/portage/repos.conf")):
-        subprocess.check_call(sudo(["mkdir", "-m", "0777", os.path.join(root_dir, "etc/portage/repos.conf")]))
+        privhelper.mkdir([os.path.join(root_dir, "etc/portage/repos.conf")], 0o777)
     if not os.path.isfile(os.path.join(root_dir, "etc/portage/repos.conf/genpack-overlay.conf")):
         with open(os.path.join(root_dir, "etc/portage/repos.conf/genpack-overlay.conf"), "w") as f:
             f.write("[genpack-overlay]\nlocation=/var/db/repos/genpack-overlay")
@@ -174,32 +350,43 @@ def scan_files(dir):
             files_found.append(os.path.join(root[len(dir) + 1:], f))
     return (files_found, newest_file)
 
+def is_already_linked(src, dst):
+    try:
+        src_stat = os.lstat(src)
+        dst_stat = os.lstat(dst)
+    except OSError:
+        return False
+    #else
+    if stat.S_ISLNK(src_stat.st_mode):
+        return stat.S_ISLNK(dst_stat.st_mode) and os.readlink(src) == os.readlink(dst)
+    #else
+    return os.path.samestat(src_stat, dst_stat)
+
 def link_files(srcdir, dstdir):
     files_to_link, newest_file = scan_files(srcdir)
-
-    for f in files_to_link:
-        src = os.path.join(srcdir, f)
-        dst = os.path.join(dstdir, f)
-        dst_dir = os.path.dirname(dst)
-        if os.path.exists(dst_dir):
-            if not os.path.isdir(dst_dir): raise Exception("%s should be a directory" % dst_dir)
-        else:
-            subprocess.check_call(sudo(["mkdir", "-p", dst_dir]))
-        if os.path.islink(src):
-            subprocess.check_call(sudo(["cp", "-d", "--remove-destination", src, dst]))
-        else:
-            subprocess.check_call(sudo(["ln", "-f", src, dst]))
+    # skip files whose destination is already the same inode(or the same symlink)
+    files_to_link = [f for f in files_to_link if not is_already_linked(os.path.join(srcdir, f), os.path.join(dstdir, f))]
+    if len(files_to_link) > 0: privhelper.run("link-files", [srcdir, dstdir], files_to_link)
     
     return newest_file
 
 def prepare(profile, disable_using_binpkg = False, setup_only = False):
+    if setup_only: return do_prepare(profile, disable_using_binpkg, setup_only)
+    #else
+    with timing.Recorder() as recorder:
+        do_prepare(profile, disable_using_binpkg, setup_only)
+    recorder.save("profiles", profile.name, "prepare")
+
+def do_prepare(profile, disable_using_binpkg = False, setup_only = False):
     extract_portage()
     gentoo_dir = profile.get_gentoo_workdir()
     fresh_stage3 = extract_stage3(gentoo_dir)
-    sync_overlay(gentoo_dir)
+    with timing.phase("sync overlay"):
+        sync_overlay(gentoo_dir)
 
     newest_file = 0
-    newest_file = max(newest_file, link_files(profile.get_dir(), gentoo_dir))
+    with timing.phase("link files"):
+        newest_file = max(newest_file, link_files(profile.get_dir(), gentoo_dir))
 
     # move files under /var/cache
     cache_dir = profile.get_cache_workdir()
@@ -223,18 +410,21 @@ def prepare(profile, disable_using_binpkg = False, setup_only = False):
 
     #else
     # install genpack-progs
-    if disable_using_binpkg:
-        print("Disabling using binary packages")
-        lower_exec(gentoo_dir, cache_dir, portage_dir, ["emerge", "-b", "--usepkg=n", "-uDN", "genpack-progs", "--keep-going"])
-    else:
-        lower_exec(gentoo_dir, cache_dir, portage_dir, ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "genpack-progs", "--keep-going"])
+    with timing.phase("emerge genpack-progs"):
+        if disable_using_binpkg:
+            print("Disabling using binary packages")
+            lower_exec(gentoo_dir, cache_dir, portage_dir, ["emerge", "-b", "--usepkg=n", "-uDN", "genpack-progs", "--keep-going"])
+        else:
+            lower_exec(gentoo_dir, cache_dir, portage_dir, ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "genpack-progs", "--keep-going"])
 
     if fresh_stage3:
         # unmerge unnecceary pythons
-        lower_exec(gentoo_dir, cache_dir, portage_dir, ["check-unwanted-pythons", "--unmerge"])
+        with timing.phase("check-unwanted-pythons"):
+            lower_exec(gentoo_dir, cache_dir, portage_dir, ["check-unwanted-pythons", "--unmerge"])
 
     # do preparation
-    lower_exec(gentoo_dir, cache_dir, portage_dir, ["genpack-prepare"] + (["--disable-using-binpkg"] if disable_using_binpkg else []))
+    with timing.phase("genpack-prepare"):
+        lower_exec(gentoo_dir, cache_dir, portage_dir, ["genpack-prepare"] + (["--disable-using-binpkg"] if disable_using_binpkg else []))
 
     if profile.get_gentoo_workdir_time() is None:
         current_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time()))
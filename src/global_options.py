@@ -4,14 +4,18 @@ _debug = False
 _base = None
 _workdir = None
 _cpus = None
+_content_digest = False
+_shared_stage3 = None
 _env = {}
 
 def read_global_options(args):
-    global _debug, _base, _workdir, _cpus
+    global _debug, _base, _workdir, _cpus, _content_digest, _shared_stage3
     _debug = args.debug
     _base = args.base
     _workdir = args.workdir
     _cpus = args.cpus
+    _content_digest = args.content_digest
+    _shared_stage3 = args.shared_stage3
     if args.env is not None:
         for e in args.env.split(","):
             name, value = e.split("=")
@@ -21,6 +25,12 @@ def read_global_options(args):
 def cpus():
     return _cpus
 
+def content_digest():
+    return _content_digest
+
+def shared_stage3():
+    return _shared_stage3
+
 def debug():
     return _debug
 
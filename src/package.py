@@ -1,4 +1,4 @@
-import os,re,subprocess
+import os,re,subprocess,functools
 from sudo import sudo
 
 def get_last_modified():
@@ -16,10 +16,12 @@ def get_dir(package, must_exist = False):
     #else
     return package_dir
 
+@functools.lru_cache(maxsize=65536)
 def strip_ver(pkgname):
-    pkgname = re.sub(r'-r[0-9]+?$', "", pkgname) # remove rev part
+    head, sep, rev = pkgname.rpartition("-r")
+    if sep != "" and rev.isascii() and rev.isdigit(): pkgname = head # remove rev part
     last_dash = pkgname.rfind('-')
-    if last_dash < 0: return pkgname
+    if last_dash < 0 or last_dash + 1 >= len(pkgname): return pkgname
     next_to_dash = pkgname[last_dash + 1]
     return pkgname[:last_dash] if pkgname.find('/') < last_dash and (next_to_dash >= '0' and next_to_dash <= '9') else pkgname
 
@@ -0,0 +1,456 @@
+import os,io,sys,stat,json,time,errno,fcntl,random,shutil,atexit,signal,socket,struct,hashlib,tempfile,threading,subprocess
+from sudo import sudo,set_prefix as set_sudo_prefix
+
+# Filesystem operations which need root privilege.
+# When genpack is not run as root, they are performed by a single helper process invoked via sudo
+# instead of spawning sudo+coreutils per file.
+# Optionally the helper keeps running as a daemon(start_daemon()) so that sudo is invoked only once per genpack run.
+# Then the ops are served over a unix socket, and sudo() makes commands run by a small client which has the daemon
+# spawn them with its stdin/stdout/stderr.
+
+_BOOTSTRAP = "import sys;sys.path.insert(0,sys.argv[1]);import privhelper;privhelper.main(sys.argv[2:])"
+
+def link_files(srcdir, dstdir, files):
+    for f in files:
+        src = os.path.join(srcdir, f)
+        dst = os.path.join(dstdir, f)
+        dst_dir = os.path.dirname(dst)
+        if os.path.exists(dst_dir):
+            if not os.path.isdir(dst_dir): raise Exception("%s should be a directory" % dst_dir)
+        else:
+            os.makedirs(dst_dir)
+        if os.path.isdir(dst) and not os.path.islink(dst): raise Exception("%s is a directory" % dst)
+        if os.path.lexists(dst): os.unlink(dst)
+        if os.path.islink(src): # cp -d --remove-destination
+            os.symlink(os.readlink(src), dst)
+        else: # ln -f
+            os.link(src, dst)
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int)
+
+def clone_file(src, dst):
+    """copy a regular file sharing its extents with src(reflink) where the filesystem supports it.
+    returns True if cloned"""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY): raise
+        # copy_file_range still avoids copying through userspace(and may share extents on some filesystems)
+        try:
+            while os.copy_file_range(s.fileno(), d.fileno(), 1024 * 1024 * 1024) > 0: pass
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP): raise
+            d.seek(0)
+            d.truncate()
+            s.seek(0)
+            shutil.copyfileobj(s, d, 1024 * 1024)
+    return False
+
+def copy_metadata(st, dst):
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode): os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+def make_parent_dirs(srcdir, dstdir, f):
+    """create missing parent directories of f under dstdir with the attributes of their source counterparts"""
+    missing = []
+    parent = os.path.dirname(f)
+    while parent not in ("", "/") and not os.path.isdir(os.path.join(dstdir, parent)):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    for d in reversed(missing):
+        os.mkdir(os.path.join(dstdir, d))
+        copy_metadata(os.stat(os.path.join(srcdir, d)), os.path.join(dstdir, d))
+
+def random_read(root_dir, seed, files):
+    """read a chunk at random offset of every regular file under root_dir in random order.
+    returns [bytes read, seconds taken]"""
+    paths = []
+    for root, dirs, filenames in os.walk(root_dir):
+        dirs.sort()
+        for f in sorted(filenames):
+            path = os.path.join(root, f)
+            if os.path.isfile(path) and not os.path.islink(path): paths.append(path)
+    rng = random.Random(int(seed))
+    rng.shuffle(paths)
+    total_bytes = 0
+    start_time = time.monotonic()
+    for path in paths:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0: continue
+            #else
+            f.seek(rng.randrange(size))
+            total_bytes += len(f.read(rng.choice([4096, 16384, 65536, 131072])))
+    return [total_bytes, time.monotonic() - start_time]
+
+def make_manifest(root_dir, previous_manifest, files):
+    """path -> [mode, uid, gid, size, mtime_ns, content] of everything under root_dir. content is sha256 of regular file,
+    link target of symlink, rdev of device or None for directory. digests in previous_manifest are reused
+    for files whose size and mtime are unchanged(same assumption as rsync's quick check)"""
+    previous = {}
+    if previous_manifest != "" and os.path.isfile(previous_manifest):
+        with open(previous_manifest) as f:
+            previous = json.load(f).get("files", {})
+    manifest = {}
+    for root, dirs, filenames in os.walk(root_dir):
+        for name in dirs + filenames:
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, root_dir)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                prev = previous.get(rel_path)
+                if prev is not None and prev[0] == st.st_mode and prev[3] == st.st_size and prev[4] == st.st_mtime_ns:
+                    content = prev[5]
+                else:
+                    h = hashlib.sha256()
+                    with open(path, "rb") as f:
+                        while chunk := f.read(1024 * 1024):
+                            h.update(chunk)
+                    content = h.hexdigest()
+            elif stat.S_ISLNK(st.st_mode): content = os.readlink(path)
+            elif stat.S_ISDIR(st.st_mode): content = None
+            else: content = st.st_rdev
+            manifest[rel_path] = [st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime_ns, content]
+    return manifest
+
+def stage_delta(upper_dir, staging_dir, files):
+    """populate staging_dir with entries of upper_dir("+path") and overlayfs whiteouts("-path")"""
+    dirs_staged = []
+    for f in sorted(files, key=lambda f:f[1:]):
+        path = f[1:]
+        make_parent_dirs(upper_dir, staging_dir, path)
+        src = os.path.join(upper_dir, path)
+        dst = os.path.join(staging_dir, path)
+        if f[0] == '-':
+            os.mknod(dst, stat.S_IFCHR, os.makedev(0, 0))
+            continue
+        #else
+        st = os.lstat(src)
+        if stat.S_ISREG(st.st_mode):
+            try:
+                os.link(src, dst) # shares inode, so metadata comes along
+                continue
+            except OSError as e:
+                if e.errno != errno.EXDEV: raise
+                clone_file(src, dst)
+        elif stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(dst): os.mkdir(dst)
+            dirs_staged.append(path)
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+        copy_metadata(st, dst)
+    for d in dirs_staged + [""]:
+        copy_metadata(os.lstat(os.path.join(upper_dir, d)), os.path.join(staging_dir, d))
+
+def make_dirs(mode, parents, files):
+    """mkdir [-p] [-m mode] files"""
+    for path in files:
+        if parents != "": os.makedirs(path, exist_ok=True)
+        else: os.mkdir(path)
+        if mode != "": os.chmod(path, int(mode, 8))
+
+def remove_files(files):
+    """rm -rf files"""
+    for path in files:
+        if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+        elif os.path.lexists(path): os.unlink(path)
+
+def move_file(src, dst, files):
+    shutil.move(src, dst)
+
+def change_owner(uid, gid, files):
+    for path in files: os.chown(path, int(uid), int(gid))
+
+def write_file(path, content, files):
+    """content is latin-1 decoded bytes so that any binary survives JSON"""
+    with open(path, "wb") as f:
+        f.write(content.encode("latin-1"))
+
+_ops = {
+    "mkdir": make_dirs,
+    "rm": remove_files,
+    "mv": move_file,
+    "chown": change_owner,
+    "write-file": write_file,
+    "link-files": link_files,
+    "random-read": random_read,
+    "manifest": make_manifest,
+    "stage-delta": stage_delta,
+}
+
+class Channel:
+    """JSON lines over unix socket. file descriptors can be attached to messages"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.fds = []
+    def send(self, message, fds = []):
+        data = (json.dumps(message) + '\n').encode("utf-8")
+        if len(fds) > 0: data = data[socket.send_fds(self.sock, [data], fds):]
+        # sending nothing would fail with EPIPE if the peer has already done its part and closed the connection
+        if len(data) > 0: self.sock.sendall(data)
+    def receive(self):
+        """next message or None on EOF. fds received are accumulated in self.fds"""
+        while b'\n' not in self.buffer:
+            data, fds, flags, address = socket.recv_fds(self.sock, 65536, 16)
+            self.fds += fds
+            if data == b'': return None
+            #else
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line)
+
+_spawned = set() # pids of processes spawned by the daemon and not reaped yet
+_spawned_lock = threading.Lock()
+
+def spawn(channel, request):
+    fds = channel.fds
+    channel.fds = []
+    try:
+        with _spawned_lock:
+            process = subprocess.Popen(request["args"], stdin=fds[0], stdout=fds[1], stderr=fds[2], cwd=request["cwd"])
+            _spawned.add(process.pid)
+    except OSError as e:
+        channel.send({"error": str(e)})
+        return
+    finally:
+        for fd in fds: os.close(fd)
+    channel.send({"pid": process.pid})
+    def forward_signals():
+        try:
+            while (message := channel.receive()) is not None:
+                if "signal" in message: kill_spawned(process.pid, message["signal"])
+        except OSError:
+            pass
+        # the client has gone without waiting for the process
+        kill_spawned(process.pid, signal.SIGKILL)
+    threading.Thread(target=forward_signals, daemon=True).start()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    with _spawned_lock:
+        _spawned.discard(process.pid)
+    process.returncode = os.waitstatus_to_exitcode(status) # reaped already
+    try:
+        channel.send({"returncode": process.returncode, "rusage": {"utime": rusage.ru_utime, "stime": rusage.ru_stime,
+            "inblock": rusage.ru_inblock, "oublock": rusage.ru_oublock, "maxrss": rusage.ru_maxrss}})
+    except OSError:
+        pass # the client has been killed
+
+def kill_spawned(pid, sig):
+    with _spawned_lock: # not to signal a reused pid
+        if pid in _spawned: os.kill(pid, sig)
+
+def kill_all_spawned(grace_seconds = 5):
+    with _spawned_lock:
+        pids = list(_spawned)
+    for pid in pids: kill_spawned(pid, signal.SIGTERM)
+    deadline = time.time() + grace_seconds
+    while time.time() < deadline:
+        with _spawned_lock:
+            if len(_spawned) == 0: return
+        time.sleep(0.1)
+    with _spawned_lock:
+        for pid in _spawned: os.kill(pid, signal.SIGKILL)
+
+def serve_connection(conn):
+    with conn:
+        channel = Channel(conn)
+        request = channel.receive()
+        if request is None: return
+        #else
+        if request["op"] == "spawn": return spawn(channel, request)
+        #else
+        try:
+            channel.send({"result": _ops[request["op"]](*request["args"], request["files"])})
+        except Exception as e:
+            channel.send({"error": str(e)})
+
+def serve(socket_path, uid):
+    """serve requests from processes of uid. exits when the first connection(the owner) is closed"""
+    uid = int(uid)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chown(socket_path, uid, -1)
+    os.chmod(socket_path, 0o600)
+    server.listen(64)
+    print("ready", flush=True)
+    def is_allowed(conn):
+        pid, peer_uid, gid = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+        return peer_uid in (uid, 0)
+    owner, address = server.accept()
+    if not is_allowed(owner): os._exit(1)
+    def wait_for_owner():
+        owner.recv(1)
+        # nothing may keep running as root after genpack has gone
+        kill_all_spawned()
+        os._exit(0)
+    threading.Thread(target=wait_for_owner, daemon=True).start()
+    while True:
+        conn, address = server.accept()
+        if not is_allowed(conn):
+            conn.close()
+            continue
+        #else
+        threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+
+FORWARDED_SIGNALS = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2, signal.SIGWINCH]
+
+def client(socket_path, *args):
+    """have the daemon run args with stdin/stdout/stderr and cwd of this process, then exit the same way as it did.
+    runs in place of sudo so that callers deal with an ordinary child process"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    channel = Channel(sock)
+    channel.send({"op": "spawn", "args": list(args), "cwd": os.getcwd()}, [0, 1, 2])
+    reply = channel.receive()
+    if reply is None or "error" in reply:
+        print("%s: %s" % (args[0], "Privileged helper closed connection" if reply is None else reply["error"]), file=sys.stderr)
+        sys.exit(1)
+    #else
+    for sig in FORWARDED_SIGNALS:
+        signal.signal(sig, lambda sig, frame: channel.send({"signal": sig}))
+    reply = channel.receive()
+    if reply is None: sys.exit(255)
+    #else
+    # the caller accounts the process as if it were its grandchild
+    with open(os.path.join(os.path.dirname(socket_path), "rusage.%d" % os.getppid()), "a") as f:
+        f.write(json.dumps(reply["rusage"]) + '\n')
+    returncode = reply["returncode"]
+    if returncode < 0: # die by the same signal
+        signal.signal(-returncode, signal.SIG_DFL)
+        os.kill(os.getpid(), -returncode)
+    sys.exit(returncode)
+
+_socket_path = None
+_spawned_rusage = {"utime": 0.0, "stime": 0.0, "inblock": 0, "oublock": 0, "maxrss": 0}
+_spawned_rusage_read = {} # pid -> bytes of its rusage file consumed
+
+def get_spawned_rusage():
+    """resource usage of the processes spawned by the daemon for this process so far(not accounted in RUSAGE_CHILDREN)"""
+    if _socket_path is None: return _spawned_rusage
+    #else
+    pid = os.getpid() # differs in forked jobs
+    if pid not in _spawned_rusage_read:
+        _spawned_rusage_read.clear()
+        _spawned_rusage.update({key: 0 for key in _spawned_rusage})
+        _spawned_rusage_read[pid] = 0
+    try:
+        with open(os.path.join(os.path.dirname(_socket_path), "rusage.%d" % pid), "rb") as f:
+            f.seek(_spawned_rusage_read[pid])
+            for line in f:
+                if not line.endswith(b'\n'): break # being written
+                #else
+                _spawned_rusage_read[pid] += len(line)
+                for key, value in json.loads(line).items():
+                    _spawned_rusage[key] = max(_spawned_rusage[key], value) if key == "maxrss" else _spawned_rusage[key] + value
+    except FileNotFoundError:
+        pass
+    return _spawned_rusage
+
+def start_daemon():
+    """start the helper as daemon(sudo asks password only here). commands made by sudo() are run by it from then on"""
+    global _socket_path
+    if os.geteuid() == 0 or _socket_path is not None: return
+    #else
+    source_root = os.path.dirname(os.path.abspath(__file__))
+    socket_dir = tempfile.mkdtemp(prefix="genpack-privhelper-")
+    socket_path = os.path.join(socket_dir, "socket")
+    daemon = subprocess.Popen(sudo([sys.executable, "-c", _BOOTSTRAP, source_root, "serve", socket_path, str(os.getuid())]),
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    if daemon.stdout.readline().strip() != b"ready": raise Exception("Privileged helper failed to start")
+    #else
+    daemon.stdout.close()
+    owner = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    owner.connect(socket_path) # the daemon exits when this is closed
+    _socket_path = socket_path
+    set_sudo_prefix([sys.executable, "-c", _BOOTSTRAP, source_root, "client", socket_path])
+    def stop_daemon():
+        global _socket_path
+        _socket_path = None
+        set_sudo_prefix(["sudo"])
+        owner.close()
+        daemon.wait()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+    atexit.register(stop_daemon)
+
+def run(op, args, files):
+    """Perform op as root. args are strings, files is a list of paths fed to the op.
+    Returns what op returns(JSON serializable values only)"""
+    if os.geteuid() == 0: return _ops[op](*args, files)
+    #else
+    if _socket_path is not None:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(_socket_path)
+            channel = Channel(sock)
+            channel.send({"op": op, "args": args, "files": files})
+            reply = channel.receive()
+        if reply is None: raise Exception("Privileged helper closed connection")
+        if "error" in reply: raise Exception(reply["error"])
+        #else
+        return reply["result"]
+    #else
+    source_root = os.path.dirname(os.path.abspath(__file__)) # works with zipapp too
+    cmdline = sudo([sys.executable, "-c", _BOOTSTRAP, source_root, op] + args)
+    helper = subprocess.Popen(cmdline, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    result, _ = helper.communicate(b''.join([f.encode("utf-8") + b'\0' for f in files]))
+    if helper.returncode != 0: raise subprocess.CalledProcessError(helper.returncode, cmdline)
+    #else
+    return json.loads(result) if result.strip() != b'' else None
+
+def call(op, args, files, cmdline):
+    """perform op by the daemon(or in this process as root). without the daemon, cmdline which does the same is run by sudo
+    instead, as starting the helper by sudo for a single op costs more than the command itself"""
+    if _socket_path is None and os.geteuid() != 0: subprocess.check_call(sudo(cmdline))
+    else: run(op, args, files)
+
+# common commands run as root. they are native ops of the daemon, sparing a client process per command
+
+def mkdir(paths, mode = None, parents = False):
+    paths = [os.path.abspath(path) for path in paths]
+    options = (["-p"] if parents else []) + (["-m", "%o" % mode] if mode is not None else [])
+    call("mkdir", ["%o" % mode if mode is not None else "", "1" if parents else ""], paths, ["mkdir"] + options + paths)
+
+def rm(paths):
+    paths = [os.path.abspath(path) for path in paths]
+    call("rm", [], paths, ["rm", "-rf"] + paths)
+
+def mv(src, dst):
+    src, dst = os.path.abspath(src), os.path.abspath(dst)
+    call("mv", [src, dst], [], ["mv", src, dst])
+
+def chown(path, uid, gid):
+    path = os.path.abspath(path)
+    call("chown", [str(uid), str(gid)], [path], ["chown", "%d:%d" % (uid, gid), path])
+
+class Tee():
+    """file written as root. the content is buffered and written at once when the daemon does it"""
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+    def __enter__(self):
+        if _socket_path is None and os.geteuid() != 0:
+            self.process = subprocess.Popen(sudo(["tee", self.filename]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            return self.process.stdin
+        #else
+        self.process = None
+        self.buffer = io.BytesIO()
+        return self.buffer
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            return
+        #else
+        run("write-file", [self.filename, self.buffer.getvalue().decode("latin-1")], [])
+
+def main(argv):
+    op = argv[0]
+    if op == "serve": return serve(*argv[1:])
+    if op == "client": return client(*argv[1:])
+    #else
+    files = [f.decode("utf-8") for f in sys.stdin.buffer.read().split(b'\0') if f != b'']
+    result = _ops[op](*argv[1:], files)
+    if result is not None: print(json.dumps(result))
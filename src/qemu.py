@@ -1,6 +1,8 @@
 import os,argparse,subprocess,tempfile
+import privhelper
 
-from sudo import sudo,Tee
+from sudo import sudo
+from privhelper import Tee
 
 class Loopback():
     def __init__(self, backing):
@@ -52,7 +54,7 @@ def run(rootfs_file, disk_image, drm=False, data_volume=False, system_ini=None):
         subprocess.check_call(sudo(["mkfs.vfat", "-F", "32", "%sp1" % loop]))
         with Tmpmount("%sp1" % loop) as mountpoint:
             grub_dir = os.path.join(mountpoint, "boot/grub")
-            subprocess.check_call(sudo(["mkdir", "-p", grub_dir]))
+            privhelper.mkdir([grub_dir], parents=True)
             with Tee(os.path.join(grub_dir, "grub.cfg")) as f:
                 f.write(grub_cfg.encode("utf-8"))
             subprocess.check_call(sudo(["grub-install", "--target=i386-pc", "--skip-fs-probe", "--boot-directory=%s" % os.path.join(mountpoint, "boot"), 
@@ -0,0 +1,122 @@
+import os,sys,logging,threading,traceback,multiprocessing,multiprocessing.connection
+import tracing
+
+class Job:
+    def __init__(self, name, func, deps = [], resource = None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        # jobs which share the same resource never run at the same time
+        self.resource = resource
+        self.state = "pending"
+    def is_ready(self):
+        return all(dep.state == "done" for dep in self.deps)
+    def is_blocked(self):
+        return any(dep.state in ("failed", "skipped") for dep in self.deps)
+
+def _relay_output(fd, prefix):
+    # written to fd 1 directly, not through sys.stdout. a job forked while this thread holds the lock of
+    # sys.stdout would inherit it locked and hang on its first flush
+    with os.fdopen(fd, "rb") as f:
+        for line in f:
+            data = prefix + line
+            while len(data) > 0: data = data[os.write(1, data):]
+
+def _run_job(job, fd):
+    # runs in forked child. everything written to stdout/stderr(including subprocesses) goes to the relay pipe
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    tracing.set_process_name(job.name)
+    try:
+        with tracing.span(job.name, "job"):
+            job.func()
+    except BaseException as e:
+        if logging.getLogger().isEnabledFor(logging.DEBUG): traceback.print_exc()
+        logging.error("Job %s failed: %s" % (job.name, str(e)))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+class _RunningJob:
+    def __init__(self, job):
+        self.job = job
+        r, w = os.pipe()
+        self.process = multiprocessing.get_context("fork").Process(target=_run_job, args=(job, w), name=job.name)
+        self.process.start()
+        os.close(w)
+        self.relay = threading.Thread(target=_relay_output, args=(r, ("[%s] " % job.name).encode("utf-8")), daemon=True)
+        self.relay.start()
+    def join(self):
+        self.process.join()
+        self.relay.join()
+        return self.process.exitcode
+
+def run(jobs, max_jobs = 1, keep_going = False):
+    """Run jobs in dependency order, up to max_jobs at once. jobs must be listed after their dependencies.
+    Returns list of failed jobs."""
+    running = {}
+    resources_in_use = set()
+    aborted = False
+    while True:
+        for job in jobs:
+            if job.state != "pending": continue
+            if job.is_blocked():
+                job.state = "skipped"
+                logging.warning("Skipping %s because its dependency has not been completed." % job.name)
+                continue
+            if aborted or len(running) >= max_jobs or not job.is_ready(): continue
+            if job.resource is not None and job.resource in resources_in_use: continue
+            #else
+            sys.stdout.flush()
+            running_job = _RunningJob(job)
+            running[running_job.process.sentinel] = running_job
+            if job.resource is not None: resources_in_use.add(job.resource)
+            job.state = "running"
+
+        if len(running) == 0: break
+        #else
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            running_job = running.pop(sentinel)
+            job = running_job.job
+            if job.resource is not None: resources_in_use.discard(job.resource)
+            if running_job.join() == 0:
+                job.state = "done"
+            else:
+                job.state = "failed"
+                if not keep_going: aborted = True
+
+    return [job for job in jobs if job.state == "failed"]
+
+class BackgroundQueue:
+    """Runs jobs in background processes, keeping at most max_jobs of them in flight.
+    submit() blocks while the queue is full."""
+    def __init__(self, max_jobs = 1):
+        self.max_jobs = max_jobs
+        self.running = {}
+        self.failed = []
+    def _wait(self):
+        for sentinel in multiprocessing.connection.wait(list(self.running.keys())):
+            running_job = self.running.pop(sentinel)
+            job = running_job.job
+            if running_job.join() == 0:
+                job.state = "done"
+            else:
+                job.state = "failed"
+                self.failed.append(job)
+    def submit(self, job):
+        while len(self.running) >= self.max_jobs: self._wait()
+        sys.stdout.flush()
+        running_job = _RunningJob(job)
+        self.running[running_job.process.sentinel] = running_job
+        job.state = "running"
+    def join(self):
+        while len(self.running) > 0: self._wait()
+        return self.failed
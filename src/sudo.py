@@ -1,15 +1,18 @@
 import os,argparse,subprocess,tempfile
 
+_prefix = ["sudo"]
+
+def set_prefix(prefix):
+    """command prefix to run commands as root. replaced while the privileged helper daemon is running"""
+    global _prefix
+    _prefix = prefix
+
 def sudo(cmdline):
     if os.geteuid() == 0: return cmdline
-    return ["sudo"] + cmdline
-
-class Tee():
-    def __init__(self, filename):
-        self.filename = filename
-    def __enter__(self):
-        self.process = subprocess.Popen(sudo(["tee", self.filename]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        return self.process.stdin
-    def __exit__(self, exception_type, exception_value, traceback):
-        self.process.stdin.close()
-        self.process.wait()
+    return _prefix + cmdline
+
+def unwrap_sudo(cmdline):
+    """command without the prefix added by sudo(). None if cmdline isn't the one sudo() returns"""
+    if cmdline[:len(_prefix)] == _prefix and len(cmdline) > len(_prefix): return cmdline[len(_prefix):]
+    if cmdline[0] == "sudo" and len(cmdline) > 1: return cmdline[1:]
+    return None
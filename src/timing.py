@@ -0,0 +1,125 @@
+import os,json,time,resource,contextlib,statistics
+import workdir,tracing,privhelper
+
+# Each phase is recorded with its wall clock time and the resource usage of this process and its children
+# during the phase. Commands run via sudo(and systemd-nspawn) are accounted too because sudo and nspawn
+# wait for their children.
+# A process which lives across phases(persistent build container) is accounted only when it is reaped,
+# so phases run in it are measured by the cgroup of the container instead(None if it can't be read).
+
+BLOCK_SIZE = 512 # unit of ru_inblock/ru_oublock
+REGRESSION_RATIO = 1.2 # slower than this ratio of baseline is reported as regression
+REGRESSION_MIN_SECONDS = 1.0 # ..as long as the difference is longer than this
+
+_recorders = []
+
+class Recorder:
+    """Collects phases which finish while it is active"""
+    def __init__(self):
+        self.phases = []
+    def __enter__(self):
+        _recorders.append(self)
+        return self
+    def __exit__(self, exception_type, exception_value, traceback):
+        _recorders.remove(self)
+    def save(self, category, name, kind):
+        """append this run to the history of name in category("profiles" or "artifacts")"""
+        run = {"time": time.time(), "kind": kind, "phases": self.phases}
+        with open(get_history_file(category, name), "a") as f:
+            f.write(json.dumps(run) + '\n')
+
+def get_cgroup_usage(cgroup_dir):
+    """resource usage of processes in cgroup(v2) so far. values which can't be read are None"""
+    def read_file(name):
+        try:
+            with open(os.path.join(cgroup_dir, name)) as f:
+                return f.read()
+        except OSError:
+            return None
+    usage = {"cpu": None, "read_bytes": None, "write_bytes": None, "max_rss_kb": None}
+    cpu_stat = read_file("cpu.stat")
+    if cpu_stat is not None:
+        usage["cpu"] = sum(int(line.split()[1]) for line in cpu_stat.splitlines() if line.startswith("usage_usec ")) / 1000000
+    io_stat = read_file("io.stat")
+    if io_stat is not None:
+        fields = [field.split('=') for field in io_stat.split() if '=' in field]
+        usage["read_bytes"] = sum(int(value) for key, value in fields if key == "rbytes")
+        usage["write_bytes"] = sum(int(value) for key, value in fields if key == "wbytes")
+    memory_peak = read_file("memory.peak")
+    if memory_peak is not None and memory_peak.strip().isdigit(): usage["max_rss_kb"] = int(memory_peak) // 1024
+    return usage
+
+@contextlib.contextmanager
+def phase(name, cgroup_dir = None):
+    """cgroup_dir: measure processes in it instead of this process and its children"""
+    start_wall = time.time()
+    start_wall_us = tracing.now_us()
+    if cgroup_dir is not None:
+        start_cgroup = get_cgroup_usage(cgroup_dir)
+    else:
+        start_self = resource.getrusage(resource.RUSAGE_SELF)
+        start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_spawned = dict(privhelper.get_spawned_rusage())
+    try:
+        yield
+    finally:
+        record = {"name": name, "start": start_wall, "wall": time.time() - start_wall}
+        if cgroup_dir is not None:
+            end_cgroup = get_cgroup_usage(cgroup_dir)
+            for key in ["cpu", "read_bytes", "write_bytes"]:
+                record[key] = end_cgroup[key] - start_cgroup[key] if end_cgroup[key] is not None and start_cgroup[key] is not None else None
+            record["max_rss_kb"] = end_cgroup["max_rss_kb"] # peak of the cgroup's lifetime so far
+        else:
+            end_self = resource.getrusage(resource.RUSAGE_SELF)
+            end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            end_spawned = privhelper.get_spawned_rusage()
+            # processes spawned by privileged helper daemon are not our children
+            delta = lambda attr: getattr(end_self, attr) - getattr(start_self, attr) + getattr(end_children, attr) - getattr(start_children, attr) \
+                + end_spawned[attr[3:]] - start_spawned[attr[3:]]
+            record["cpu"] = delta("ru_utime") + delta("ru_stime")
+            record["read_bytes"] = delta("ru_inblock") * BLOCK_SIZE
+            record["write_bytes"] = delta("ru_oublock") * BLOCK_SIZE
+            # rusage has no per-phase peak. this is the peak so far, so an upper bound of the phase's
+            record["max_rss_kb"] = max(end_self.ru_maxrss, end_children.ru_maxrss, end_spawned["maxrss"])
+        for recorder in _recorders: recorder.phases.append(record)
+        tracing.complete(name, "phase", start_wall_us, tracing.now_us(), None, 
+            {key:value for key,value in record.items() if key not in ("name", "start", "wall")})
+
+HISTORY_CATEGORIES = ["profiles", "artifacts"]
+
+def get_history_file(category, name):
+    return os.path.join(workdir.get_arch(os.path.join("index/timings", category)), "%s.jsonl" % name.replace('/', '_'))
+
+def get_history_names(category):
+    history_dir = workdir.get_arch(os.path.join("index/timings", category), False)
+    if not os.path.isdir(history_dir): return []
+    #else
+    return sorted([f[:-6] for f in os.listdir(history_dir) if f.endswith(".jsonl")])
+
+def load_history(category, name):
+    history_file = get_history_file(category, name)
+    if not os.path.isfile(history_file): return []
+    #else
+    runs = []
+    with open(history_file) as f:
+        for line in f:
+            try:
+                runs.append(json.loads(line))
+            except ValueError:
+                pass # partially written line
+    return runs
+
+def compare(runs, num_baseline_runs = 5):
+    """compare the last run with median of the previous ones per phase.
+    returns list of (phase name, seconds of last run, baseline seconds or None, regression or not)"""
+    if len(runs) == 0: return []
+    #else
+    last = runs[-1]
+    baseline_runs = runs[-1 - num_baseline_runs:-1]
+    rows = []
+    for p in last["phases"]:
+        previous = [q["wall"] for run in baseline_runs for q in run["phases"] if q["name"] == p["name"]]
+        baseline = statistics.median(previous) if len(previous) > 0 else None
+        regression = baseline is not None and p["wall"] > baseline * REGRESSION_RATIO and p["wall"] - baseline > REGRESSION_MIN_SECONDS
+        rows.append((p["name"], p["wall"], baseline, regression))
+    return rows
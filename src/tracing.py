@@ -0,0 +1,94 @@
+import os,json,time,atexit,threading,subprocess,contextlib
+from sudo import unwrap_sudo
+
+# Chrome trace event(Perfetto compatible) export.
+# Events are appended line by line to an intermediate file so that forked job processes can emit them too.
+# The main process turns them into a single JSON document at exit.
+
+_output = None
+_events_file = None
+_main_pid = None
+_original_popen = subprocess.Popen
+
+def now_us():
+    return time.monotonic_ns() // 1000 # CLOCK_MONOTONIC is consistent across processes
+
+def is_enabled():
+    return _events_file is not None
+
+def emit(event):
+    if _events_file is None: return
+    #else
+    fd = os.open(_events_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(event) + '\n').encode("utf-8"))
+    finally:
+        os.close(fd)
+
+def complete(name, category, start_us, end_us, tid = None, args = {}):
+    emit({"name": name, "cat": category, "ph": "X", "ts": start_us, "dur": end_us - start_us,
+        "pid": os.getpid(), "tid": tid if tid is not None else threading.get_native_id(), "args": args})
+
+@contextlib.contextmanager
+def span(name, category, args = {}):
+    if not is_enabled():
+        yield
+        return
+    #else
+    start_us = now_us()
+    try:
+        yield
+    finally:
+        complete(name, category, start_us, now_us(), None, args)
+
+def set_process_name(name):
+    emit({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": name}})
+
+class TracedPopen(_original_popen):
+    """Popen which emits a span from spawn to reap. Each process gets its own track(tid = its pid)."""
+    def __init__(self, args, *popenargs, **kwargs):
+        self._trace_start_us = now_us()
+        self._trace_cmdline = [args] if isinstance(args, (str, bytes, os.PathLike)) else list(args)
+        self._trace_done = False
+        super().__init__(args, *popenargs, **kwargs)
+    def _trace(self):
+        if self._trace_done or self.returncode is None: return
+        #else
+        self._trace_done = True
+        cmdline = [a.decode("utf-8", "replace") if isinstance(a, bytes) else str(a) for a in self._trace_cmdline]
+        program = (unwrap_sudo(cmdline) or cmdline)[0]
+        complete(os.path.basename(program), "subprocess", self._trace_start_us, now_us(), self.pid,
+            {"cmdline": " ".join(cmdline), "returncode": self.returncode})
+    def wait(self, timeout = None):
+        returncode = super().wait(timeout)
+        self._trace()
+        return returncode
+    def poll(self):
+        returncode = super().poll()
+        self._trace()
+        return returncode
+
+def enable(output):
+    global _output, _events_file, _main_pid
+    _output = output
+    _events_file = "%s.events.%d" % (output, os.getpid())
+    _main_pid = os.getpid()
+    if os.path.exists(_events_file): os.unlink(_events_file)
+    subprocess.Popen = TracedPopen # subprocess.run(), check_call() etc. look it up at call time
+    set_process_name("genpack")
+    atexit.register(finalize)
+
+def finalize():
+    if os.getpid() != _main_pid or not os.path.exists(_events_file): return
+    #else
+    events = []
+    with open(_events_file) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass # process killed while writing
+    with open(_output, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.unlink(_events_file)
+    print("Trace written to %s(%d events)." % (_output, len(events)))
@@ -1,21 +1,70 @@
-import os,re,subprocess,logging,urllib.request,urllib.error
-import arch
+import os,re,json,time,hashlib,logging,threading,urllib.request,urllib.error,urllib.parse
+import arch,user_dir
 
 _base_url = "http://ftp.iij.ad.jp/pub/linux/gentoo/"
 _downloaded = set()
 USER_AGENT = "genpack/0.1"
+DOWNLOAD_TIMEOUT = 60
+CHUNK_SIZE = 1024 * 1024
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024 # files smaller than this are not split into multiple connections
+_download_connections = 1
+METADATA_TTL = 3600 # seconds to trust resolved stage3 urls and freshness of downloaded files without asking the server
+_offline = False
 
 def set_base_url(base_url):
     global _base_url
     _base_url = base_url
     if not _base_url.endswith('/'): base_url += '/'
 
+def set_download_connections(connections):
+    global _download_connections
+    _download_connections = max(1, connections)
+
+def set_offline(offline):
+    global _offline
+    _offline = offline
+
+def is_offline():
+    return _offline
+
+def get_metadata_cache_path():
+    return os.path.join(user_dir.get_genpack_user_dir(), "upstream-cache.json")
+
+def get_cached_metadata(key):
+    """value cached within METADATA_TTL(or of any age when offline). None if not cached"""
+    cache = load_meta(get_metadata_cache_path()) or {}
+    if key not in cache: return None
+    #else
+    if not _offline and time.time() - cache[key]["time"] > METADATA_TTL: return None
+    #else
+    return cache[key]["value"]
+
+def set_cached_metadata(key, value):
+    cache_path = get_metadata_cache_path()
+    cache = load_meta(cache_path) or {}
+    cache[key] = {"time": time.time(), "value": value}
+    # drop expired entries
+    cache = {k:v for k,v in cache.items() if time.time() - v["time"] <= METADATA_TTL * 24}
+    tmpfile = "%s.%d.tmp" % (cache_path, os.getpid())
+    save_meta(tmpfile, cache)
+    os.replace(tmpfile, cache_path)
+
 def url_readlines(url):
     req = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
     with urllib.request.urlopen(req) as f:
         return f.read().decode('utf-8').splitlines()
 
 def get_latest_stage3_tarball_url(variant = "systemd"):
+    """None if offline and the url has never been resolved"""
+    cache_key = "stage3-url:%s:%s:%s" % (_base_url, arch.get(), variant)
+    url = get_cached_metadata(cache_key)
+    if url is not None or _offline: return url
+    #else
+    url = resolve_latest_stage3_tarball_url(variant)
+    set_cached_metadata(cache_key, url)
+    return url
+
+def resolve_latest_stage3_tarball_url(variant = "systemd"):
     _arch = arch.get()
     _arch2 = arch.get()
     if _arch == "x86_64": _arch = _arch2 = "amd64"
@@ -62,18 +111,211 @@ def get_content_length(url):
     logging.warning("Failed to get Content-Length for %s", url)
     return None
 
-def download_if_necessary(url, save_as):
+def load_meta(meta_file):
+    if not os.path.isfile(meta_file): return None
+    #else
+    try:
+        with open(meta_file) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+def save_meta(meta_file, meta):
+    with open(meta_file, "w") as f:
+        json.dump(meta, f)
+
+def head(url, headers = {}):
+    """returns (status, validators) where validators is dict of url, length, etag, last_modified and accept_ranges"""
+    req = urllib.request.Request(url, method="HEAD", headers=dict({'User-Agent': USER_AGENT}, **headers))
+    try:
+        with urllib.request.urlopen(req, timeout=DOWNLOAD_TIMEOUT) as f:
+            content_length = f.headers.get("Content-Length")
+            return (f.status, {"url": url, "length": int(content_length) if content_length is not None else None,
+                "etag": f.headers.get("ETag"), "last_modified": f.headers.get("Last-Modified"),
+                "accept_ranges": f.headers.get("Accept-Ranges") == "bytes"})
+    except urllib.error.HTTPError as e:
+        if e.code == 304: return (304, None)
+        #else
+        raise
+
+def is_up_to_date(url, save_as):
+    """True/False as the server says. None if the server couldn't be asked"""
+    meta = load_meta(save_as + ".meta")
+    if meta is not None and meta.get("url") != url: return False
+    if meta is None:
+        # downloaded by older version of genpack. compare size only
+        content_length = get_content_length(url)
+        return None if content_length is None else os.path.getsize(save_as) == content_length
+    #else
+    headers = {}
+    if meta.get("etag") is not None: headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified") is not None: headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        status, validators = head(url, headers)
+    except (urllib.error.URLError, OSError) as e:
+        logging.warning("Failed to check %s: %s" % (url, str(e)))
+        return None
+    if status == 304: return True
+    #else some servers ignore conditional HEAD
+    if validators["length"] is not None and validators["length"] != os.path.getsize(save_as): return False
+    if validators["etag"] is not None: return validators["etag"] == meta.get("etag")
+    if validators["last_modified"] is not None: return validators["last_modified"] == meta.get("last_modified")
+    #else
+    return validators["length"] is not None
+
+class Download:
+    """downloads url into save_as + ".part" in one or more segments(ranges), each fetched by its own connection.
+    progress is stored in save_as + ".part.meta" so that an interrupted download resumes where it stopped,
+    as long as the remote file is unchanged(ETag/Last-Modified/length)"""
+    def __init__(self, url, save_as):
+        self.url = url
+        self.save_as = save_as
+        self.part_file = save_as + ".part"
+        self.part_meta_file = self.part_file + ".meta"
+        self.lock = threading.Lock()
+        self.last_progress_time = 0
+    def prepare(self):
+        try:
+            status, validators = head(self.url)
+        except urllib.error.HTTPError as e: # HEAD not allowed?
+            logging.warning("HEAD request for %s failed: %s" % (self.url, str(e)))
+            validators = {"url": self.url, "length": None, "etag": None, "last_modified": None, "accept_ranges": False}
+        meta = load_meta(self.part_meta_file)
+        if meta is not None and os.path.isfile(self.part_file) and all(meta.get(key) == validators[key] for key in ["url", "length", "etag", "last_modified"]) and meta["accept_ranges"]:
+            done = sum([segment[2] for segment in meta["segments"]])
+            print("Resuming download of %s from %d bytes" % (self.url, done))
+            self.meta = meta
+            return
+        #else
+        self.meta = validators
+        length = validators["length"]
+        if length is None or not validators["accept_ranges"]:
+            self.meta["segments"] = [[0, length, 0]] # [start, end(exclusive), bytes done]
+        else:
+            num_segments = max(1, min(_download_connections, length // SEGMENT_MIN_SIZE))
+            segment_size = length // num_segments
+            self.meta["segments"] = [[i * segment_size, length if i == num_segments - 1 else (i + 1) * segment_size, 0] for i in range(num_segments)]
+        with open(self.part_file, "wb") as f:
+            if length is not None: f.truncate(length)
+    def fetch_segment(self, fd, segment):
+        start, end, done = segment
+        if end is not None and start + done >= end: return
+        #else
+        headers = {'User-Agent': USER_AGENT}
+        if self.meta["accept_ranges"]:
+            headers["Range"] = "bytes=%d-%s" % (start + done, "" if end is None else str(end - 1))
+            # fail rather than receiving whole the file if it has been changed in the meantime
+            if_range = self.meta.get("etag") or self.meta.get("last_modified")
+            if if_range is not None: headers["If-Range"] = if_range
+        req = urllib.request.Request(self.url, headers=headers)
+        with urllib.request.urlopen(req, timeout=DOWNLOAD_TIMEOUT) as f:
+            if "Range" in headers and f.status != 206: raise Exception("Server didn't respond with partial content(%d). Remote file has changed?" % f.status)
+            while chunk := f.read(min(CHUNK_SIZE, end - start - segment[2]) if end is not None else CHUNK_SIZE):
+                os.pwrite(fd, chunk, start + segment[2])
+                with self.lock:
+                    segment[2] += len(chunk)
+                    self.print_progress()
+                if end is not None and start + segment[2] >= end: break
+        if end is not None and start + segment[2] < end: raise Exception("Connection closed before completing download of %s" % self.url)
+    def print_progress(self, force = False):
+        now = time.time()
+        if not force and now - self.last_progress_time < 1: return
+        #else
+        self.last_progress_time = now
+        done = sum([segment[2] for segment in self.meta["segments"]])
+        length = self.meta["length"]
+        if length: print("\r%d/%d bytes(%d%%)" % (done, length, done * 100 // length), end="", flush=True)
+        else: print("\r%d bytes" % done, end="", flush=True)
+    def run(self):
+        self.prepare()
+        errors = []
+        def fetch(fd, segment):
+            try:
+                self.fetch_segment(fd, segment)
+            except Exception as e:
+                errors.append(e)
+        fd = os.open(self.part_file, os.O_WRONLY | os.O_CREAT)
+        try:
+            threads = [threading.Thread(target=fetch, args=(fd, segment)) for segment in self.meta["segments"]]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+        finally:
+            os.close(fd)
+            self.print_progress(True)
+            print()
+            save_meta(self.part_meta_file, self.meta)
+        if len(errors) > 0: raise errors[0]
+        #else
+        os.replace(self.part_file, self.save_as)
+        del self.meta["segments"]
+        save_meta(self.save_as + ".meta", self.meta)
+        os.unlink(self.part_meta_file)
+
+def get_expected_digest(digests_url, filename):
+    """reads DIGESTS file published next to stage3 tarballs. returns (algorithm, hexdigest) or None"""
+    digests = {}
+    algorithm = None
+    for line in url_readlines(digests_url):
+        m = re.match(r'^#\s+(\w+)\s+HASH', line)
+        if m:
+            algorithm = m.group(1).lower()
+            continue
+        #else
+        splitted = line.split()
+        if algorithm is not None and len(splitted) == 2 and splitted[1] == filename: digests[algorithm] = splitted[0].lower()
+    for algorithm in ["sha512", "blake2b", "sha256"]:
+        if algorithm in digests: return (algorithm, digests[algorithm])
+    #else
+    return None
+
+def verify_digest(save_as, digests_url, filename):
+    try:
+        expected = get_expected_digest(digests_url, filename)
+    except (urllib.error.URLError, OSError) as e:
+        logging.warning("Failed to get %s: %s" % (digests_url, str(e)))
+        return
+    if expected is None:
+        logging.warning("No digest for %s found in %s" % (filename, digests_url))
+        return
+    #else
+    algorithm, expected_digest = expected
+    h = hashlib.new(algorithm)
+    with open(save_as, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    if h.hexdigest() != expected_digest:
+        os.unlink(save_as)
+        if os.path.exists(save_as + ".meta"): os.unlink(save_as + ".meta")
+        raise Exception("%s digest mismatch for %s" % (algorithm.upper(), save_as))
+    #else
+    print("%s digest verified" % algorithm.upper())
+
+def download_if_necessary(url, save_as, digests_url = None):
     if (url,save_as) in _downloaded: return False
     _downloaded.add((url,save_as))
+    if _offline or url is None:
+        if not os.path.exists(save_as): raise Exception("%s is not available offline" % save_as)
+        #else
+        print("Using %s(offline)" % save_as)
+        return False
+    #else
+    checked_key = "checked:%s:%s" % (url, os.path.abspath(save_as))
     if os.path.exists(save_as):
-        content_length = get_content_length(url)
-        if content_length is None or os.path.getsize(save_as) == get_content_length(url):
+        if get_cached_metadata(checked_key):
+            # not refreshed here. the TTL counts from the last time the server was actually asked
+            print("Skipping download of %s" % url)
+            return False
+        #else
+        up_to_date = is_up_to_date(url, save_as)
+        if up_to_date is not False: # keep the existing file if the server couldn't be asked
             print("Skipping download of %s" % url)
+            if up_to_date: set_cached_metadata(checked_key, True)
             return False
     #else
     print("Downloading %s" % url)
-    # download using wget
-    subprocess.check_call(["wget", "-O", save_as, url])
+    Download(url, save_as).run()
+    if digests_url is not None: verify_digest(save_as, digests_url, os.path.basename(urllib.parse.urlparse(url).path))
+    set_cached_metadata(checked_key, True)
     return True
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import os,fcntl,logging
-import arch
+import arch,tracing
 
 genpack_user_dir = os.path.expanduser('~/.genpack')
 
@@ -31,7 +31,8 @@ class lockfile:
     def __init__(self, lockfile_path):
         self.lockfile = open(lockfile_path, "a+")
         print("Waiting for lock on %s..." % lockfile_path, flush=True, end="")
-        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        with tracing.span("lock %s" % os.path.basename(lockfile_path), "lock"):
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
         print("Acquired.")
     def __enter__(self):
         return self.lockfile
@@ -1,5 +1,5 @@
 import os,uuid,subprocess
-import arch
+import arch,privhelper
 from sudo import sudo
 
 _root = os.path.join(os.getcwd(), "work")
@@ -41,26 +41,78 @@ def get_artifact(artifact, relpath = None, create=True):
 def get_trash(create=True):
     return get("trash", create)
 
+def unmount_all(path):
+    """unmount everything mounted on or under path(deepest first)"""
+    path = os.path.abspath(path)
+    mountpoints = []
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            mountpoint = line.split(' ')[1].replace("\\040", " ").replace("\\011", "\t").replace("\\012", "\n").replace("\\134", "\\")
+            if mountpoint == path or mountpoint.startswith(path + "/"): mountpoints.append(mountpoint)
+    for mountpoint in sorted(mountpoints, key=len, reverse=True):
+        subprocess.check_call(sudo(["umount", mountpoint]))
+
 def move_to_trash(path, noexist_ok = False):
     if not os.path.exists(path):
         if noexist_ok: return
         #else
         raise Exception("No such file or directory: %s" % path)
     #else
+    unmount_all(path)
     trash_dir = get_trash()
     os.makedirs(trash_dir, exist_ok=True)
-    subprocess.check_call(sudo(["mv", path, os.path.join(trash_dir, str(uuid.uuid4()))]))
+    privhelper.mv(path, os.path.join(trash_dir, str(uuid.uuid4())))
 
 def cleanup_trash():
     trash_dir = get_trash(False)
     if not os.path.exists(trash_dir): return
     #else
-    print("Cleaning up %s..." % trash_dir)
-    subprocess.check_call(sudo(["rm", "-rf", trash_dir]))
+    # claim entries by renaming them. rename is atomic so an entry is claimed by only one of concurrent genpack runs
+    paths = []
+    for entry in os.listdir(trash_dir):
+        path = os.path.join(trash_dir, entry)
+        if entry.startswith(".reaping-"): # being deleted by another run's reaper or left by a reaper which has died
+            paths.append(path)
+            continue
+        elif entry.startswith('.'): continue
+        #else
+        claimed_path = os.path.join(trash_dir, ".reaping-" + entry)
+        try:
+            os.rename(path, claimed_path)
+            paths.append(claimed_path)
+        except FileNotFoundError:
+            pass # claimed by another run
+        except OSError:
+            paths.append(path)
+    if len(paths) == 0: return
+    #else
+    print("Cleaning up %s in background..." % trash_dir)
+    # the list is passed by file rather than by pipe so that this process doesn't have to wait for the reaper to read it
+    list_file = os.path.join(trash_dir, ".reaper-list-%s" % uuid.uuid4())
+    with open(list_file, "wb") as f:
+        f.write(b''.join([path.encode("utf-8") + b'\0' for path in paths]))
+    # the reaper detaches from this process(setsid -f) so that it survives exit.
+    # it reports "started" once it has checked its tools and detached, then waits for the lock.
+    # reapers of concurrent runs take turns by the lock, so that nothing is deleted twice at the same time.
+    reaper_script = 'for tool in flock ionice xargs; do command -v $tool >/dev/null || exit 1; done\n' \
+        + 'echo started\nexec >/dev/null 2>&1\n' \
+        + 'flock "$2" nice -n 19 ionice -c 3 xargs -0 -a "$1" -n 1 -P "$3" rm -rf --\nrm -f "$1"\n'
+    reaper_cmdline = ["setsid", "-f", "sh", "-c", reaper_script, "sh", list_file, os.path.join(trash_dir, ".reaper.lock"), str(os.cpu_count() or 1)]
+    try:
+        reaper = subprocess.Popen(sudo(reaper_cmdline), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        started = reaper.stdout.read() == b"started\n" # EOF without it if setsid, sh or a tool is missing
+        reaper.stdout.close()
+        reaper.wait()
+    except OSError:
+        started = False
+    if not started:
+        print("Background cleanup is not available. Cleaning up %s..." % trash_dir)
+        privhelper.rm([list_file] + paths)
 
 def clean():
     archdir = get_arch(None, False)
     profiles = os.path.join(archdir, "profiles")
     artifacts = os.path.join(archdir, "artifacts")
-    subprocess.check_call(sudo(["rm", "-rf", profiles, artifacts]))
+    unmount_all(profiles)
+    privhelper.rm([profiles, artifacts])
 